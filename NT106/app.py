@@ -1,9 +1,24 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+import os
+
+# SocketIO async mode: 'threading' (mặc định, tương thích Python 3.12), 'eventlet' hoặc 'gevent'
+# eventlet/gevent phải monkey-patch trước khi import các module khác
+# → set qua biến môi trường của process, không đọc từ .env
+SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if SOCKETIO_ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif SOCKETIO_ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g
 from flask_socketio import SocketIO, emit, join_room
 from dotenv import load_dotenv
 from functools import wraps
-from datetime import datetime
-import os
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import io
 import time
 import threading
 
@@ -14,10 +29,21 @@ from core.crypto_manager import CryptoManager
 from core.e2ee_manager import E2EEManager
 from core.tcp_messenger import TCPMessenger
 from core.admin_key_manager import AdminKeyManager
+from core.json_provider import orjson, OrjsonProvider, SocketIOJSON
+from core.schemas import (
+    SchemaError, SendMessageRequest, EncryptRequest, DecryptRequest, UserIdRequest,
+    decode_json, decode_form
+)
 
 # Load biến môi trường
 load_dotenv()
 
+# Cấu hình instance (đọc 1 lần lúc import, dùng lại ở mọi request)
+TCP_PORT = int(os.environ.get('TCP_PORT', 9999))
+# TCP_REUSEPORT=1: các instance cùng bind TCP_PORT (SO_REUSEPORT), kernel chia connection thay cho TCP LB
+TCP_REUSEPORT = os.environ.get('TCP_REUSEPORT') == '1'
+INSTANCE_ID = os.environ.get('INSTANCE_ID', '1')
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'mac_dinh_neu_khong_co_env')
 
@@ -28,68 +54,104 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour
 
+# JSON encode bằng orjson cho jsonify (nếu đã cài)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
 # Khởi tạo SocketIO cho Multi-Client Real-time
-# Dùng threading thay vì eventlet để tương thích Python 3.12
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# - eventlet/gevent: WebSocket transport thật, 1 greenlet/connection thay vì 1 OS thread
+# - REDIS_URL: message queue chung để emit(room=...) tới được client ở instance khác
+# - orjson: mỗi emit encode payload nhanh hơn json chuẩn ~3-5x
+socketio_options = {'json': SocketIOJSON} if orjson is not None else {}
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=SOCKETIO_ASYNC_MODE,
+    message_queue=os.getenv('REDIS_URL'),
+    **socketio_options
+)
 
 # Khởi tạo Database và Crypto
 db = Database()
 crypto = CryptoManager()
 e2ee = E2EEManager()
 # TCP Socket cho messaging - sử dụng TCP_PORT từ environment
-tcp_port = int(os.environ.get('TCP_PORT', 9999))
-tcp_messenger = TCPMessenger(port=tcp_port)
+tcp_messenger = TCPMessenger(port=TCP_PORT, reuse_port=TCP_REUSEPORT)
 admin_key = AdminKeyManager()  # Master key cho data at rest
 
 # --- [NEW] KHỞI TẠO S3 MANAGER ---
 s3_manager = S3Manager()
+# Upload file đính kèm chạy nền để api_send không bị block bởi network I/O của S3
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='s3-upload')
 
 # --- [NEW] BACKGROUND THREAD CHO IMAP SYNC ---
 class EmailSyncWorker:
     """
     Background thread để sync email từ IMAP định kỳ
     Đáp ứng yêu cầu Thread trong rubric
+    
+    - Bỏ qua hoàn toàn khi không có user nào có credentials IMAP
+    - Exponential backoff khi không có việc: interval → 2x → 4x ... (tối đa max_interval)
+    - Dùng threading.Event để stop() có hiệu lực ngay, không phải chờ hết sleep
     """
-    def __init__(self, interval=30):
-        self.interval = interval  # Sync mỗi 30 giây
+    def __init__(self, database, interval=30, max_interval=480):
+        self.db = database
+        self.interval = interval  # Sync mỗi 30 giây khi có việc
+        self.max_interval = max_interval
         self.running = False
         self.thread = None
+        self._stop = threading.Event()
     
     def start(self):
         if not self.running:
             self.running = True
+            self._stop.clear()
             self.thread = threading.Thread(target=self._sync_loop, daemon=True)
             self.thread.start()
             print("[THREAD] Background Email Sync Worker started.")
     
     def stop(self):
         self.running = False
+        self._stop.set()
+    
+    def _next_delay(self, empty_passes):
+        """Thời gian chờ tới lần sync tiếp theo"""
+        return min(self.max_interval, self.interval * (2 ** min(empty_passes, 16)))
     
     def _sync_loop(self):
         """Loop chính để sync email định kỳ"""
-        while self.running:
+        empty_passes = 0
+        while not self._stop.is_set():
             try:
-                # Lấy danh sách tất cả users có gmail_app_password
-                # (Trong thực tế, chỉ sync cho users đang online)
-                # Ở đây đơn giản hóa: sync cho tất cả users
-                
-                print(f"[THREAD] Running email sync...")
-                
-                # TODO: Implement logic sync cho tất cả users
-                # Hiện tại chỉ log để biết thread đang chạy
-                
-                time.sleep(self.interval)
+                # Chỉ sync khi có user có credentials IMAP
+                if self.db.count_users_with_imap() == 0:
+                    empty_passes += 1
+                else:
+                    empty_passes = 0
+                    print(f"[THREAD] Running email sync...")
+                    
+                    # TODO: Implement logic sync cho tất cả users
+                    # Hiện tại chỉ log để biết thread đang chạy
             except Exception as e:
                 print(f"[THREAD ERROR] {e}")
-                time.sleep(self.interval)
+            
+            self._stop.wait(self._next_delay(empty_passes))
 
-# Khởi tạo và start background worker
-email_sync_worker = EmailSyncWorker(interval=30)
-email_sync_worker.start()
+# Khởi tạo background worker (start trong start_background_services)
+email_sync_worker = EmailSyncWorker(db, interval=30)
 
-# Start TCP messenger server
-tcp_messenger.start_server()
-print("[TCP] Messenger server started")
+def start_background_services():
+    """
+    Start các service nền của 1 backend instance: incremental vacuum, email sync, TCP messenger
+    Chỉ process chính của instance gọi (app.py __main__ / post_worker_init của gunicorn.conf.py),
+    import app (vd asgi.py) không start gì → worker chỉ phục vụ HTTP không tranh bind TCP_PORT
+    """
+    db.start_incremental_vacuum()
+    email_sync_worker.start()
+    
+    # Start TCP messenger server
+    tcp_messenger.start_server()
+    print("[TCP] Messenger server started")
 
 # ===== RBAC AUTHORIZATION DECORATOR =====
 def require_permission(resource, action):
@@ -108,10 +170,13 @@ def require_permission(resource, action):
             if 'user_email' not in session:
                 return jsonify({'error': 'Unauthorized'}), 401
             
-            # Get user role
-            user = db.get_user_by_email(session['user_email'])
-            if not user:
-                return jsonify({'error': 'User not found'}), 401
+            # Get user role (memo trong g cho cả vòng đời request)
+            user = g.get('current_user')
+            if user is None:
+                user = db.get_user_by_email(session['user_email'])
+                if not user:
+                    return jsonify({'error': 'User not found'}), 401
+                g.current_user = user
             
             role = user.get('role', 'user')
             
@@ -128,14 +193,47 @@ def require_permission(resource, action):
         return decorated_function
     return decorator
 
+# --- TIMESTAMP CACHE ---
+# (epoch giây, chuỗi ISO UTC) - chỉ format lại khi sang giây mới, gán tuple nên an toàn giữa các thread
+_now_iso_cache = (0, '')
+
+def now_iso():
+    """Timestamp ISO 8601 UTC (độ phân giải giây) cho payload gửi client"""
+    global _now_iso_cache
+    sec = int(time.time())
+    cached_sec, cached_iso = _now_iso_cache
+    if sec != cached_sec:
+        cached_iso = datetime.fromtimestamp(sec, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        _now_iso_cache = (sec, cached_iso)
+    return cached_iso
+
 # --- SOCKETIO EVENTS (MULTI-CLIENT SUPPORT) ---
+def conversation_room(email_a, email_b):
+    """Tên room dùng chung của 1 cuộc hội thoại (không phụ thuộc ai gửi)"""
+    if email_a > email_b:
+        email_a, email_b = email_b, email_a
+    return f"conv:{email_a}:{email_b}"
+
+def join_conversation_rooms(user_email):
+    """Join room của tất cả cuộc hội thoại mà user tham gia"""
+    for contact in db.get_contact_emails(user_email):
+        join_room(conversation_room(user_email, contact))
+
 @socketio.on('connect')
 def handle_connect():
     if 'user_email' in session:
+        # Room riêng theo email: dùng cho event điều khiển (conversation mới, ...)
         join_room(session['user_email'])
+        join_conversation_rooms(session['user_email'])
         print(f"[SOCKET] User {session['user_email']} connected")
         emit('status', {'message': 'Connected to Delta Chat'})
 
+@socketio.on('join_conversations')
+def handle_join_conversations():
+    """Client gọi lại khi có cuộc hội thoại mới để join room của nó"""
+    if 'user_email' in session:
+        join_conversation_rooms(session['user_email'])
+
 @socketio.on('disconnect')
 def handle_disconnect():
     if 'user_email' in session:
@@ -151,37 +249,32 @@ def health_check():
     ⚡ OPTIMIZED: Không check S3 vì slow (network call)
     Dùng /health?full=1 để check đầy đủ
     """
-    import socket as sock
-    from datetime import datetime
-    
     full_check = request.args.get('full', '0') == '1'
     
     health_status = {
         'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'instance': os.environ.get('INSTANCE_ID', '1'),
+        'timestamp': now_iso(),
+        'instance': INSTANCE_ID,
         'services': {}
     }
     
     # Check Database (fast - local SQLite)
     try:
-        conn = db.get_connection()
-        conn.execute("SELECT 1")
+        with db.pool.connection() as conn:
+            conn.execute("SELECT 1")
         health_status['services']['database'] = 'up'
     except Exception as e:
         health_status['services']['database'] = f'down: {str(e)}'
         health_status['status'] = 'unhealthy'
     
-    # Check TCP Messenger (fast - local socket)
-    try:
-        test_sock = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
-        test_sock.settimeout(0.5)  # Giảm timeout từ 1s xuống 0.5s
-        tcp_port = int(os.environ.get('TCP_PORT', 9999))
-        test_sock.connect(('127.0.0.1', tcp_port))
-        test_sock.close()
+    # Check TCP Messenger (O(1) - đọc liveness flag, không self-connect)
+    # Process chỉ phục vụ HTTP (asgi.py) không chạy messenger → bỏ qua thay vì báo unhealthy
+    if not tcp_messenger.running:
+        health_status['services']['tcp_messenger'] = 'skipped (HTTP-only worker)'
+    elif tcp_messenger.healthy():
         health_status['services']['tcp_messenger'] = 'up'
-    except Exception as e:
-        health_status['services']['tcp_messenger'] = f'down: {str(e)}'
+    else:
+        health_status['services']['tcp_messenger'] = 'down: not listening'
         health_status['status'] = 'unhealthy'
     
     # Check S3 (SLOW - chỉ check khi full=1)
@@ -197,9 +290,6 @@ def health_check():
     status_code = 200 if health_status['status'] == 'healthy' else 503
     return jsonify(health_status), status_code
 
-# --- [NEW] KHỞI TẠO S3 MANAGER ---
-s3_manager = S3Manager()
-
 # --- ROUTE 1: TRANG ĐĂNG KÝ ---
 @app.route('/register')
 def register():
@@ -216,18 +306,15 @@ def register_action():
     if password != confirm_password:
         return render_template('register.html', error="Mật khẩu không khớp!")
     
-    # Đăng ký vào database (không cần gmail_app_password)
-    result = db.register_user(username, email, password)
+    # Generate E2EE keypair cho user mới
+    private_key, public_key = e2ee.generate_keypair()
+    
+    # Đăng ký vào database (không cần gmail_app_password), public key lưu cùng transaction
+    result = db.register_user(username, email, password, public_key=public_key)
     
     if result['success']:
         user_id = result['user_id']
         
-        # Generate E2EE keypair cho user mới
-        private_key, public_key = e2ee.generate_keypair()
-        
-        # Lưu public key vào database
-        db.save_public_key(email, public_key)
-        
         # Lưu private key vào session để gửi cho client
         session['new_user_private_key'] = private_key
         session['new_user_email'] = email
@@ -298,19 +385,16 @@ def api_encrypt():
     if 'user_email' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
-    message = data.get('message')
-    my_private_key = data.get('my_private_key')
-    recipient_public_key = data.get('recipient_public_key')
-    
-    if not all([message, my_private_key, recipient_public_key]):
+    try:
+        req = decode_json(request.get_data(), EncryptRequest)
+    except SchemaError:
         return jsonify({'error': 'Missing parameters'}), 400
     
     try:
         encrypted = e2ee.encrypt_for_recipient(
-            message,
-            my_private_key,
-            recipient_public_key
+            req.message,
+            req.my_private_key,
+            req.recipient_public_key
         )
         return jsonify({'encrypted_message': encrypted})
     except Exception as e:
@@ -323,19 +407,16 @@ def api_decrypt():
     if 'user_email' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
-    encrypted_message = data.get('encrypted_message')
-    my_private_key = data.get('my_private_key')
-    sender_public_key = data.get('sender_public_key')
-    
-    if not all([encrypted_message, my_private_key, sender_public_key]):
+    try:
+        req = decode_json(request.get_data(), DecryptRequest)
+    except SchemaError:
         return jsonify({'error': 'Missing parameters'}), 400
     
     try:
         decrypted = e2ee.decrypt_from_sender(
-            encrypted_message,
-            my_private_key,
-            sender_public_key
+            req.encrypted_message,
+            req.my_private_key,
+            req.sender_public_key
         )
         return jsonify({'decrypted_message': decrypted})
     except Exception as e:
@@ -356,27 +437,35 @@ def chat():
 # --- SETUP ROUTES REMOVED - No Gmail App Password needed ---
 
 # --- ROUTE 4: API GỬI TIN NHẮN (CÓ MÃ HÓA) ---
+UPLOAD_PLACEHOLDER = "[Đang tải lên]"
+
 @app.route('/api/send', methods=['POST'])
 def api_send():
     if 'user_email' not in session:
         return jsonify({"status": "error", "message": "Chưa đăng nhập"}), 401
 
-    recipient = request.form.get('recipient')
-    subject = request.form.get('subject', '[Delta-Chat]')  # Subject đặc biệt để lọc
-    body = request.form.get('body', '')
+    try:
+        req = decode_form(request.form, SendMessageRequest)
+    except SchemaError as e:
+        return jsonify({"status": "error", "message": f"Dữ liệu không hợp lệ: {e}"}), 400
+
+    recipient = req.recipient
+    subject = req.subject
+    body = req.body
     attachment = request.files.get('attachment')
-    enable_encryption = request.form.get('encrypt', 'false') == 'true'
+    enable_encryption = req.encrypt
 
-    # 1. Upload file đính kèm lên S3 (nếu có)
+    # 1. Upload file đính kèm lên S3 (nếu có) - chạy nền, body tạm thời là placeholder
     is_file = False
+    pending_upload = None
     if attachment:
-        try:
-            file_url = s3_manager.upload_file(attachment, attachment.filename)
-            if file_url:
-                body += f"\n\n{file_url}"
-                is_file = True
-        except Exception as e:
-            return jsonify({"status": "error", "message": f"Lỗi S3: {str(e)}"})
+        # Đọc file ra bộ nhớ vì request stream bị đóng khi request kết thúc
+        filename = attachment.filename
+        file_obj = io.BytesIO(attachment.stream.read())
+        pending_upload = UPLOAD_EXECUTOR.submit(s3_manager.upload_file, file_obj, filename)
+        text_body = body
+        body += f"\n\n{UPLOAD_PLACEHOLDER} {filename}"
+        is_file = True
 
     # 2. Mã hóa tin nhắn (nếu được bật)
     original_body = body
@@ -394,10 +483,12 @@ def api_send():
             encrypted=enable_encryption
         )
         
+        # Cuộc hội thoại mới → người nhận chưa join room chung
+        new_conversation = not db.has_conversation(session['user_email'], recipient)
+        
         # 4. Lưu vào Database để sync nhanh
         # Sinh message_id giả (thực tế sẽ lấy từ IMAP sau)
-        import uuid
-        msg_id = str(uuid.uuid4())
+        msg_id = uuid4().hex
         db.save_message(
             msg_id, 
             session['user_email'], 
@@ -412,25 +503,73 @@ def api_send():
         # 6. Broadcast qua SocketIO cho NGƯỜI GỬI và NGƯỜI NHẬN
         # Sử dụng room-based emit - mỗi user join room = email khi connect
         message_data = {
+            'message_id': msg_id,
             'sender': session['user_email'],
             'recipient': recipient,
             'body': original_body,
             'subject': subject,
-            'timestamp': datetime.now().isoformat() + 'Z'
+            'timestamp': now_iso()
         }
         
-        # Emit vào room của NGƯỜI NHẬN (để họ nhận tin realtime)
-        socketio.emit('new_message', message_data, room=recipient, namespace='/')
-        
-        # Emit vào room của NGƯỜI GỬI (để sync các tab khác của họ)
-        socketio.emit('new_message', message_data, room=session['user_email'], namespace='/')
+        broadcast_message('new_message', message_data, new_conversation=new_conversation)
         
-        print(f"[SOCKET] Emitted new_message to rooms: {recipient}, {session['user_email']}")
+        # 7. Khi upload xong: cập nhật body trong DB + emit 'file_ready'
+        if pending_upload:
+            pending_upload.add_done_callback(
+                lambda future: _finish_attachment_upload(future, message_data, text_body, filename)
+            )
         
-        return jsonify({"status": "success"})
+        return jsonify({"status": "success", "message_id": msg_id})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
 
+def broadcast_message(event, message_data, new_conversation=False):
+    """
+    Emit 1 lần vào room chung của cuộc hội thoại (người nhận + mọi tab của người gửi)
+    Cuộc hội thoại mới: chưa ai join room chung → emit vào room riêng của từng người,
+    client thấy new_conversation=True sẽ gọi 'join_conversations'
+    """
+    if new_conversation:
+        message_data = dict(message_data, new_conversation=True)
+        socketio.emit(event, message_data, room=message_data['recipient'], namespace='/')
+        socketio.emit(event, message_data, room=message_data['sender'], namespace='/')
+        print(f"[SOCKET] Emitted {event} to rooms: {message_data['recipient']}, {message_data['sender']}")
+        return
+    
+    room = conversation_room(message_data['sender'], message_data['recipient'])
+    socketio.emit(event, message_data, room=room, namespace='/')
+    print(f"[SOCKET] Emitted {event} to room: {room}")
+
+def _finish_attachment_upload(future, message_data, text_body, filename):
+    """Callback (chạy ở thread upload) khi S3 upload hoàn tất"""
+    try:
+        file_url = future.result()
+    except Exception as e:
+        print(f"[ERROR] S3 upload error: {e}")
+        file_url = None
+    
+    if file_url:
+        body = f"{text_body}\n\n{file_url}"
+    else:
+        body = f"{text_body}\n\n[Lỗi S3: không upload được {filename}]"
+    
+    db.update_message_body(message_data['message_id'], body)
+    broadcast_message('file_ready', dict(message_data, body=body))
+
+def _decrypt_message_row(msg):
+    """Giải mã body của 1 message dict (tại chỗ) nếu được đánh dấu mã hóa"""
+    if msg.get('is_encrypted'):
+        msg['body'] = crypto.decrypt_message_body(msg['body'])
+    return msg
+
+MAX_PAGE_SIZE = 200
+
+def _page_args(default_limit):
+    """Đọc cursor keyset (?before=<timestamp>&before_id=<id>&limit=N) từ query string"""
+    # Kẹp cả 2 đầu: limit <= 0 tới SQLite thành LIMIT -1 (không giới hạn) / trang rỗng
+    limit = max(1, min(request.args.get('limit', default_limit, type=int), MAX_PAGE_SIZE))
+    return request.args.get('before'), request.args.get('before_id', type=int), limit
+
 # --- ROUTE 5: API NHẬN TIN (SYNC STRATEGY - CHỈ DELTA CHAT) ---
 @app.route('/api/get_messages')
 def api_get_messages():
@@ -451,13 +590,12 @@ def api_get_messages():
         return jsonify([])
     
     try:
-        # Lấy tin nhắn từ Database (đã deduplicate bằng UNIQUE message_id)
-        messages = db.get_all_messages_for_user(session['user_email'], limit=100)
-        
-        # Giải mã tin nhắn nếu cần
-        for msg in messages:
-            if msg.get('is_encrypted'):
-                msg['body'] = crypto.decrypt_message_body(msg['body'])
+        # Stream tin nhắn từ Database (đã deduplicate bằng UNIQUE message_id)
+        # và giải mã ngay trong 1 lượt duyệt
+        messages = [
+            _decrypt_message_row(msg)
+            for msg in db.iter_messages_for_user(session['user_email'], *_page_args(100))
+        ]
         
         return jsonify(messages)
     
@@ -480,14 +618,11 @@ def api_messages_by_conversation(conversation_id):
     if 'user_email' not in session:
         return jsonify([])
     
-    messages = db.get_messages_by_conversation(conversation_id)
-    
-    # Giải mã nếu cần
-    for msg in messages:
-        if msg.get('is_encrypted'):
-            msg['body'] = crypto.decrypt_message_body(msg['body'])
-    
-    return jsonify(messages)
+    # Giải mã ngay trong lúc stream từ cursor (1 pass, không list trung gian)
+    return jsonify([
+        _decrypt_message_row(msg)
+        for msg in db.iter_messages_by_conversation(conversation_id, *_page_args(50))
+    ])
 # ===== ADMIN ROUTES =====
 
 @app.route('/admin')
@@ -523,14 +658,12 @@ def admin_get_messages(current_user=None):
     limit = request.args.get('limit', 100, type=int)
     messages = db.get_all_messages_admin(limit)
     
-    # Decrypt messages with admin key
-    for msg in messages:
-        try:
-            # If encrypted with admin key
-            if msg['body'] and msg['body'].startswith('ENC:'):
-                msg['body'] = admin_key.decrypt_data(msg['body'][4:])
-        except:
-            pass  # Keep encrypted if can't decrypt
+    # Decrypt messages with admin key (1 lần gọi batch cho tất cả body ENC:)
+    encrypted_msgs = [msg for msg in messages if msg['body'] and msg['body'].startswith('ENC:')]
+    decrypted = admin_key.decrypt_batch([msg['body'][4:] for msg in encrypted_msgs])
+    for msg, plaintext in zip(encrypted_msgs, decrypted):
+        if plaintext is not None:  # Keep encrypted if can't decrypt
+            msg['body'] = plaintext
     
     return jsonify(messages)
 
@@ -614,8 +747,10 @@ def api_find_user_by_id():
     if 'user_email' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
-    search_id = data.get('user_id', '').strip()
+    try:
+        search_id = decode_json(request.get_data(), UserIdRequest).user_id.strip()
+    except SchemaError:
+        return jsonify({'error': 'User ID required'}), 400
     
     if not search_id:
         return jsonify({'error': 'User ID required'}), 400
@@ -643,8 +778,10 @@ def api_add_friend():
     if 'user_email' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
-    friend_id = data.get('user_id', '').strip()
+    try:
+        friend_id = decode_json(request.get_data(), UserIdRequest).user_id.strip()
+    except SchemaError:
+        return jsonify({'error': 'User ID required'}), 400
     
     if not friend_id:
         return jsonify({'error': 'User ID required'}), 400
@@ -661,6 +798,11 @@ def api_add_friend():
     # Create conversation (if not exists)
     conv_id = db.get_or_create_conversation(session['user_email'], friend['email'])
     
+    # Báo cho cả 2 bên join room chung của cuộc hội thoại
+    conversation_event = {'user': session['user_email'], 'contact': friend['email']}
+    socketio.emit('conversation_created', conversation_event, room=friend['email'], namespace='/')
+    socketio.emit('conversation_created', conversation_event, room=session['user_email'], namespace='/')
+    
     return jsonify({
         'success': True,
         'friend': {
@@ -674,13 +816,16 @@ def api_add_friend():
 if __name__ == '__main__':
     # Get port from environment (for load balancing)
     flask_port = int(os.environ.get('PORT', 5000))
-    tcp_port = int(os.environ.get('TCP_PORT', 9999))
-    instance_id = os.environ.get('INSTANCE_ID', '1')
     
-    print(f"🚀 Starting Delta Chat Instance #{instance_id}")
+    print(f"🚀 Starting Delta Chat Instance #{INSTANCE_ID}")
     print(f"   Flask Port: {flask_port}")
-    print(f"   TCP Port: {tcp_port}")
+    print(f"   TCP Port: {TCP_PORT}")
     print(f"   Ready for Load Balancer")
     
+    start_background_services()
+    
     # Sử dụng SocketIO.run thay vì app.run để hỗ trợ WebSocket
-    socketio.run(app, debug=False, port=flask_port, host='0.0.0.0', allow_unsafe_werkzeug=True)
\ No newline at end of file
+    # Production: gunicorn -c gunicorn.conf.py app:app (eventlet, keep-alive)
+    # Chỉ mode 'threading' mới rơi về Werkzeug dev server
+    run_options = {'allow_unsafe_werkzeug': True} if SOCKETIO_ASYNC_MODE == 'threading' else {}
+    socketio.run(app, debug=False, port=flask_port, host='0.0.0.0', **run_options)
\ No newline at end of file
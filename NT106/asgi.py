@@ -0,0 +1,20 @@
+"""
+ASGI entry point cho HTTP API
+Chạy: uvicorn asgi:asgi_app --workers 4
+
+Lưu ý: Flask-SocketIO không chạy được trên ASGI → WebSocket vẫn phục vụ bởi
+process app.py (SOCKETIO_ASYNC_MODE=eventlet để không tốn 1 OS thread/connection).
+Entry này chỉ dùng cho các route REST (/api/*, /health) phía sau load balancer.
+
+Worker ASGI chỉ phục vụ HTTP: import app không start TCP messenger, email sync, vacuum
+(start_background_services chỉ chạy ở process app.py / gunicorn). Vì vậy:
+- /health của worker ASGI bỏ qua tcp_messenger thay vì trả 503
+- BẮT BUỘC set REDIS_URL (chung với process app.py): socketio.emit từ /api/send chạy trong
+  worker ASGI chỉ tới được client WebSocket qua Redis message queue
+"""
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app
+
+asgi_app = WsgiToAsgi(app)
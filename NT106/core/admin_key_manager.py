@@ -28,6 +28,9 @@ class AdminKeyManager:
         """
         self.master_key_path = master_key_path
         self.master_key = self._load_or_generate_key()
+        # AESGCM object dùng chung: key schedule chỉ tính 1 lần
+        # (an toàn giữa các thread vì mỗi lần encrypt dùng nonce riêng)
+        self._aesgcm = AESGCM(self.master_key)
         print(f"[ADMIN KEY] ✅ Master key initialized: {master_key_path}")
     
     def _load_or_generate_key(self):
@@ -78,14 +81,11 @@ class AdminKeyManager:
             return ""
         
         try:
-            # Create AESGCM cipher
-            aesgcm = AESGCM(self.master_key)
-            
             # Generate random 96-bit nonce
             nonce = os.urandom(12)
             
             # Encrypt (GCM mode includes authentication tag automatically)
-            ciphertext = aesgcm.encrypt(
+            ciphertext = self._aesgcm.encrypt(
                 nonce,
                 plaintext.encode('utf-8'),
                 None  # No additional authenticated data
@@ -120,11 +120,8 @@ class AdminKeyManager:
             nonce = encrypted_blob[:12]
             ciphertext = encrypted_blob[12:]
             
-            # Create AESGCM cipher
-            aesgcm = AESGCM(self.master_key)
-            
             # Decrypt and verify authentication tag
-            plaintext = aesgcm.decrypt(nonce, ciphertext, None)
+            plaintext = self._aesgcm.decrypt(nonce, ciphertext, None)
             
             return plaintext.decode('utf-8')
         
@@ -132,6 +129,34 @@ class AdminKeyManager:
             print(f"[ADMIN KEY ERROR] Decryption failed: {e}")
             raise ValueError("Decryption failed - data may be corrupted or key is wrong")
     
+    def decrypt_batch(self, encrypted_list):
+        """
+        Giải mã nhiều blob cùng lúc (dùng cho admin xem danh sách tin nhắn)
+        
+        Bind sẵn b64decode / AESGCM.decrypt ra biến local để vòng lặp không phải
+        tra attribute và khởi tạo cipher cho từng phần tử
+        
+        Args:
+            encrypted_list: List các Base64-encoded encrypted data
+            
+        Returns:
+            list: Plaintext tương ứng, None cho blob không giải mã được
+        """
+        b64decode = base64.b64decode
+        decrypt = self._aesgcm.decrypt
+        
+        results = []
+        for encrypted_base64 in encrypted_list:
+            if not encrypted_base64:
+                results.append("")
+                continue
+            try:
+                blob = b64decode(encrypted_base64)
+                results.append(decrypt(blob[:12], blob[12:], None).decode('utf-8'))
+            except Exception:
+                results.append(None)
+        return results
+    
     def rotate_key(self, new_key_path='master_new.key'):
         """
         Key rotation: Generate new key và re-encrypt tất cả data
@@ -1,28 +1,74 @@
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import pad, unpad
-import base64
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import binascii
 import hashlib
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# PyCryptodome là optional (chỉ dùng cho legacy CBC decrypt)
+# Không có wheel (vd Raspberry Pi) → fallback sang OpenSSL qua cryptography
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Util.Padding import unpad
+    _HAVE_PYCRYPTO = True
+except ImportError:
+    _HAVE_PYCRYPTO = False
+
+# NumPy optional: XOR chain buffer bằng uint64 ufunc (SIMD), không có thì dùng int XOR
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BLOCK_SIZE = 16  # AES block size
+
+
+def _xor_bytes(a, b):
+    """XOR 2 buffer cùng độ dài (bội số của 16 bytes)"""
+    if np is not None:
+        return (np.frombuffer(a, dtype=np.uint64) ^ np.frombuffer(b, dtype=np.uint64)).tobytes()
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
 
 """
-⚠️ DEPRECATION WARNING:
-CryptoManager sử dụng AES-CBC (vulnerable to padding oracle attacks).
-
-🔐 NÊN SỬ DỤNG: E2EEManager (core/e2ee_manager.py)
-   - AES-GCM-256 (authenticated encryption)
-   - ECDH key exchange
-   - Per-message nonce
-   - Better security
-
-CryptoManager được giữ lại chỉ để:
-- Decrypt messages cũ trong database
-- Backward compatibility
+CryptoManager: mã hóa tin nhắn phía server bằng AES-256-GCM
+(cryptography/OpenSSL → AES-NI + PCLMULQDQ, authenticated encryption)
+
+🔐 E2EE giữa 2 user: dùng E2EEManager (core/e2ee_manager.py)
+
+Tin nhắn cũ (AES-CBC, prefix [ENCRYPTED] / [ENCRYPTED_CBC]) vẫn đọc được
+qua _decrypt_cbc để backward compatibility.
 """
 
+GCM_PREFIX = "[ENCRYPTED_GCM]"
+CBC_PREFIX = "[ENCRYPTED_CBC]"
+LEGACY_PREFIX = "[ENCRYPTED]"  # Tin nhắn CBC trước khi có tag mode
+
+# Độ dài prefix tính sẵn → cắt bằng slice O(1), không replace() quét cả body
+GCM_PREFIX_LEN = len(GCM_PREFIX)
+CBC_PREFIX_LEN = len(CBC_PREFIX)
+LEGACY_PREFIX_LEN = len(LEGACY_PREFIX)
+
+# Bản bytes của prefix cho body đọc thẳng từ socket/DB dạng bytes (ASCII → cùng độ dài)
+GCM_PREFIX_B = GCM_PREFIX.encode('ascii')
+CBC_PREFIX_B = CBC_PREFIX.encode('ascii')
+LEGACY_PREFIX_B = LEGACY_PREFIX.encode('ascii')
+
+# Giới hạn tìm ']' khi dispatch prefix → O(1) bất kể độ dài body
+MAX_PREFIX_LEN = max(GCM_PREFIX_LEN, CBC_PREFIX_LEN, LEGACY_PREFIX_LEN)
+
+NONCE_SIZE = 12  # 96-bit nonce chuẩn cho GCM
+TAG_SIZE = 16    # GCM auth tag nối sau ciphertext
+NONCE_POOL_COUNT = 256  # Số nonce lấy mỗi lần refill (1 syscall getrandom / 256 message)
+
 class CryptoManager:
     """
-    Mã hóa/Giải mã tin nhắn bằng AES-256-CBC
-    ⚠️ DEPRECATED: Dùng E2EEManager thay vì class này
+    Mã hóa/Giải mã tin nhắn bằng AES-256-GCM
     """
     
     def __init__(self, secret_key=None):
@@ -34,79 +80,260 @@ class CryptoManager:
         
         # Tạo key 256-bit từ secret_key bằng SHA-256
         self.key = hashlib.sha256(secret_key.encode()).digest()
+        
+        # AEAD object dùng lại cho mọi message
+        self._aead = AESGCM(self.key)
+        
+        # ECB cipher (key schedule tính 1 lần) cho legacy CBC decrypt
+        if _HAVE_PYCRYPTO:
+            self._ecb = AES.new(self.key, AES.MODE_ECB)
+        else:
+            self._ecb = Cipher(algorithms.AES(self.key), modes.ECB())
+        
+        # Bảng dispatch prefix → hàm giải mã (str và bytes)
+        self._prefix_dispatch = {
+            GCM_PREFIX: self.decrypt,
+            CBC_PREFIX: self._decrypt_cbc,
+            LEGACY_PREFIX: self._decrypt_cbc,
+        }
+        self._prefix_dispatch_b = {
+            GCM_PREFIX_B: self.decrypt,
+            CBC_PREFIX_B: self._decrypt_cbc,
+            LEGACY_PREFIX_B: self._decrypt_cbc,
+        }
+        
+        # Pool nonce refill từ os.urandom; lock vì Flask gọi từ nhiều thread
+        self._nonce_pool = b''
+        self._nonce_off = 0
+        self._nonce_lock = threading.Lock()
+        
+        # Process con sau fork phải bỏ pool, nếu không 2 process dùng trùng nonce
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: ref() and ref()._reset_nonce_pool())
+    
+    def _reset_nonce_pool(self):
+        self._nonce_pool = b''
+        self._nonce_off = 0
+        self._nonce_lock = threading.Lock()
+    
+    def _ecb_decrypt(self, data):
+        """ECB decrypt toàn bộ buffer (độ dài phải chia hết cho 16)"""
+        if _HAVE_PYCRYPTO:
+            return self._ecb.decrypt(data)
+        # Context của cryptography có state → tạo decryptor mới mỗi lần cho thread-safe
+        decryptor = self._ecb.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+    
+    @staticmethod
+    def _unpad(data):
+        """Bỏ PKCS#7 padding, ValueError nếu padding sai"""
+        if _HAVE_PYCRYPTO:
+            return unpad(data, BLOCK_SIZE)
+        unpadder = padding.PKCS7(BLOCK_SIZE * 8).unpadder()
+        return unpadder.update(data) + unpadder.finalize()
+    
+    def _nonce(self):
+        """Lấy 12 bytes nonce từ pool, refill os.urandom(12 * 256) khi hết"""
+        with self._nonce_lock:
+            if self._nonce_off >= len(self._nonce_pool):
+                self._nonce_pool = os.urandom(NONCE_SIZE * NONCE_POOL_COUNT)
+                self._nonce_off = 0
+            off = self._nonce_off
+            self._nonce_off = off + NONCE_SIZE
+            return self._nonce_pool[off:off + NONCE_SIZE]
+    
+    def _encrypt_b64(self, plaintext):
+        """AES-GCM encrypt, trả về base64 dạng bytes (không lỗi với plaintext str hợp lệ)"""
+        # Nonce ngẫu nhiên 12 bytes cho mỗi message (mỗi slice của pool chỉ cấp 1 lần)
+        nonce = self._nonce()
+        return binascii.b2a_base64(self._seal(nonce, plaintext.encode('utf-8')), newline=False)
+    
+    def _seal(self, nonce, data):
+        """
+        nonce | ciphertext | tag trong 1 bytearray cấp phát đúng size,
+        b2a_base64 đọc thẳng buffer này (không tạo bytes trung gian khi nối)
+        """
+        buf = bytearray(NONCE_SIZE + len(data) + TAG_SIZE)
+        buf[:NONCE_SIZE] = nonce
+        buf[NONCE_SIZE:] = self._aead.encrypt(nonce, data, None)
+        return buf
     
     def encrypt(self, plaintext):
         """
-        Mã hóa văn bản
+        Mã hóa văn bản (AES-GCM)
         :param plaintext: Văn bản gốc (string)
-        :return: Văn bản đã mã hóa (base64 string)
+        :return: base64(nonce + ciphertext + tag)
         """
+        return self._encrypt_b64(plaintext).decode('ascii')
+    
+    def decrypt(self, encrypted_text):
+        """
+        Giải mã văn bản (AES-GCM)
+        :param encrypted_text: base64(nonce + ciphertext + tag), str hoặc bytes
+        :return: Văn bản gốc (string), None nếu sai key/bị sửa
+        """
+        # binascii.Error / UnicodeDecodeError là subclass của ValueError
         try:
-            # Tạo IV ngẫu nhiên (16 bytes cho AES)
-            iv = get_random_bytes(16)
-            
-            # Tạo cipher AES-CBC
-            cipher = AES.new(self.key, AES.MODE_CBC, iv)
-            
-            # Padding văn bản để chia hết cho block size (16 bytes)
-            padded_text = pad(plaintext.encode('utf-8'), AES.block_size)
-            
-            # Mã hóa
-            ciphertext = cipher.encrypt(padded_text)
-            
-            # Gộp IV + Ciphertext và encode base64 để dễ truyền qua mạng
-            encrypted_data = iv + ciphertext
-            return base64.b64encode(encrypted_data).decode('utf-8')
-        
-        except Exception as e:
-            print(f"[CRYPTO ERROR] Encrypt failed: {e}")
+            encrypted_data = binascii.a2b_base64(encrypted_text)
+            nonce = encrypted_data[:NONCE_SIZE]
+            ciphertext = encrypted_data[NONCE_SIZE:]
+            return self._aead.decrypt(nonce, ciphertext, None).decode('utf-8')
+        except (ValueError, InvalidTag) as e:
+            logger.debug("Decrypt failed: %r", e)
             return None
     
-    def decrypt(self, encrypted_text):
+    def encrypt_many(self, plaintexts):
+        """
+        Mã hóa nhiều văn bản 1 lượt (re-encrypt archive / migration)
+        Sinh toàn bộ nonce bằng 1 lần os.urandom, dùng chung AEAD object
+        :return: list base64 string
+        """
+        nonces = os.urandom(NONCE_SIZE * len(plaintexts))
+        results = []
+        for i, plaintext in enumerate(plaintexts):
+            nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+            sealed = self._seal(nonce, plaintext.encode('utf-8'))
+            results.append(binascii.b2a_base64(sealed, newline=False).decode('ascii'))
+        return results
+    
+    def decrypt_many(self, encrypted_texts):
         """
-        Giải mã văn bản
-        :param encrypted_text: Văn bản đã mã hóa (base64 string)
-        :return: Văn bản gốc (string)
+        Giải mã nhiều văn bản AES-GCM 1 lượt
+        :return: list string (None tại vị trí lỗi)
+        """
+        return [self.decrypt(text) for text in encrypted_texts]
+    
+    def _decrypt_cbc(self, encrypted_text):
+        """
+        Giải mã tin nhắn cũ AES-256-CBC (chỉ đọc, không còn mã hóa bằng CBC)
+        :param encrypted_text: base64(IV + ciphertext), str hoặc bytes
         """
         try:
             # Decode base64
-            encrypted_data = base64.b64decode(encrypted_text)
+            encrypted_data = binascii.a2b_base64(encrypted_text)
             
             # Tách IV (16 bytes đầu) và Ciphertext
             iv = encrypted_data[:16]
             ciphertext = encrypted_data[16:]
             
-            # Tạo cipher để giải mã
-            cipher = AES.new(self.key, AES.MODE_CBC, iv)
-            
-            # Giải mã và xóa padding
-            decrypted_padded = cipher.decrypt(ciphertext)
-            plaintext = unpad(decrypted_padded, AES.block_size)
+            # CBC decrypt: P_i = D(C_i) XOR C_{i-1} (C_0 = IV)
+            # → giải mã toàn bộ block bằng ECB đã cache rồi XOR 1 lần, không dựng lại key schedule
+            if not ciphertext or len(ciphertext) % BLOCK_SIZE:
+                raise ValueError(f"invalid length {len(ciphertext)}")
+            blocks = self._ecb_decrypt(ciphertext)
+            chain = iv + ciphertext[:-BLOCK_SIZE]
+            decrypted_padded = _xor_bytes(blocks, chain)
+            plaintext = self._unpad(decrypted_padded)
             
             return plaintext.decode('utf-8')
         
-        except Exception as e:
-            print(f"[CRYPTO ERROR] Decrypt failed: {e}")
+        except ValueError as e:  # base64 hỏng / sai độ dài block / padding sai
+            logger.debug("CBC decrypt failed: %r", e)
             return None
     
+    def _decrypt_cbc_many(self, encrypted_texts):
+        """
+        Giải mã nhiều tin nhắn CBC cũ: gom mọi block vào 1 buffer,
+        1 lần ECB decrypt + 1 lần XOR với buffer chain (IV/C_{i-1}) rồi tách lại theo message
+        """
+        results = [None] * len(encrypted_texts)
+        spans = []  # (index, offset, length)
+        cipher_buf = bytearray()
+        chain_buf = bytearray()
+        
+        for i, text in enumerate(encrypted_texts):
+            try:
+                data = binascii.a2b_base64(text)
+            except binascii.Error as e:
+                logger.debug("CBC decrypt failed: %r", e)
+                continue
+            iv, ciphertext = data[:16], data[16:]
+            if not ciphertext or len(ciphertext) % BLOCK_SIZE:
+                logger.debug("CBC decrypt failed: invalid length %d", len(ciphertext))
+                continue
+            spans.append((i, len(cipher_buf), len(ciphertext)))
+            cipher_buf += ciphertext
+            chain_buf += iv + ciphertext[:-BLOCK_SIZE]
+        
+        if not spans:
+            return results
+        
+        blocks = self._ecb_decrypt(bytes(cipher_buf))
+        decrypted = _xor_bytes(blocks, chain_buf)
+        
+        for i, offset, length in spans:
+            try:
+                results[i] = self._unpad(decrypted[offset:offset + length]).decode('utf-8')
+            except ValueError as e:  # Padding sai / UTF-8 lỗi
+                logger.debug("CBC decrypt failed: %r", e)
+        return results
+    
     def encrypt_message_body(self, body):
         """
         Mã hóa nội dung tin nhắn và thêm prefix để nhận biết
         """
-        encrypted = self.encrypt(body)
+        encrypted = self._encrypt_b64(body)
         if encrypted:
-            return f"[ENCRYPTED]{encrypted}"
+            return (GCM_PREFIX_B + encrypted).decode('ascii')
         return body
     
+    @staticmethod
+    def _lookup_prefix(body, table, open_bracket, close_bracket):
+        """
+        Tìm hàm giải mã theo prefix [TAG] ở đầu body
+        Không bắt đầu bằng '[' → plaintext ngay, ']' chỉ tìm trong MAX_PREFIX_LEN ký tự đầu
+        :return: (hàm giải mã hoặc None, vị trí bắt đầu phần mã hóa)
+        """
+        if body[:1] != open_bracket:
+            return None, 0
+        end = body.find(close_bracket, 0, MAX_PREFIX_LEN)
+        if end < 0:
+            return None, 0
+        return table.get(body[:end + 1]), end + 1
+    
     def decrypt_message_body(self, body):
         """
-        Giải mã nội dung tin nhắn nếu có prefix [ENCRYPTED]
+        Giải mã nội dung tin nhắn theo prefix: [ENCRYPTED_GCM], [ENCRYPTED_CBC] hoặc [ENCRYPTED] (CBC cũ)
         """
-        if body.startswith("[ENCRYPTED]"):
-            encrypted_part = body.replace("[ENCRYPTED]", "")
-            decrypted = self.decrypt(encrypted_part)
-            return decrypted if decrypted else "[Lỗi giải mã]"
-        return body
+        decrypt, start = self._lookup_prefix(body, self._prefix_dispatch, '[', ']')
+        if decrypt is None:
+            return body
+        decrypted = decrypt(body[start:])
+        return decrypted if decrypted else "[Lỗi giải mã]"
+    
+    def decrypt_message_body_bytes(self, body):
+        """
+        Như decrypt_message_body nhưng nhận body dạng bytes
+        So prefix trên bytes, base64 decode thẳng từ bytes,
+        chỉ decode UTF-8 1 lần ở plaintext cuối
+        """
+        decrypt, start = self._lookup_prefix(body, self._prefix_dispatch_b, b'[', b']')
+        if decrypt is None:
+            return body.decode('utf-8')
+        decrypted = decrypt(body[start:])
+        return decrypted if decrypted else "[Lỗi giải mã]"
+    
+    def decrypt_message_bodies(self, bodies):
+        """
+        Bản batch của decrypt_message_body (giữ nguyên thứ tự)
+        Tin nhắn CBC cũ được giải mã chung 1 lượt qua _decrypt_cbc_many
+        """
+        results = list(bodies)
+        cbc_index, cbc_texts = [], []
+        
+        for i, body in enumerate(bodies):
+            decrypt, start = self._lookup_prefix(body, self._prefix_dispatch, '[', ']')
+            if decrypt is None:
+                continue
+            if decrypt == self._decrypt_cbc:
+                cbc_index.append(i)
+                cbc_texts.append(body[start:])
+            else:
+                results[i] = decrypt(body[start:]) or "[Lỗi giải mã]"
+        
+        for i, decrypted in zip(cbc_index, self._decrypt_cbc_many(cbc_texts)):
+            results[i] = decrypted if decrypted else "[Lỗi giải mã]"
+        return results
 
 
 # TEST CODE
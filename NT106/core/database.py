@@ -1,204 +1,448 @@
 import sqlite3
+import base64
+import binascii
 import hashlib
+import hmac
 import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.request import pathname2url
 
-class Database:
-    def __init__(self, db_path="delta_chat.db"):
-        """
-        Khởi tạo Database SQLite cho Delta Chat
-        """
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+PBKDF2_ITERATIONS = 100000
+SALT_SIZE = 16
+
+# RETURNING (UPSERT / UPDATE) cần SQLite 3.35+
+HAS_UPSERT_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Cache kết quả verify PBKDF2 thành công: login lặp lại trong TTL không phải chạy lại 100k vòng
+VERIFY_CACHE_TTL = 300  # giây
+
+# PRAGMA user_version hiện tại; tăng khi thêm migration trong Database._migrations
+SCHEMA_VERSION = 3
+
+# User ID: 8 byte ngẫu nhiên (16 hex, 64 bit); thử lại khi trùng UNIQUE
+USER_ID_BYTES = 8
+USER_ID_RETRIES = 5
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection thuộc về ConnectionPool
+    close() trả connection về pool thay vì đóng file database
+    """
+    pool = None
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
+    """
+    Pool các connection SQLite dùng lại giữa các request
+    
+    - 1 connection ghi (read-write) dùng chung, khóa bằng threading.Lock
+      → các lệnh ghi được tuần tự hóa trong process, không bị SQLITE_BUSY
+    - N connection chỉ đọc (mode=ro) trong queue.LifoQueue - connection vừa dùng
+      được lấy lại trước nên page cache vẫn còn nóng
+    - Khi pool đọc rỗng thì mở thêm connection mới thay vì chặn request
+    - check_same_thread=False: mỗi connection chỉ được 1 thread dùng tại 1 thời điểm
+    """
+    
+    # Áp dụng cho mọi connection
+    PRAGMAS = (
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-64000",       # ~64MB page cache
+        "PRAGMA mmap_size=268435456",     # 256MB memory-mapped I/O
+    )
+    
+    # Prepared statement cache của sqlite3 (key = chuỗi SQL) - connection sống lâu trong pool
+    # nên mỗi câu SQL chỉ parse 1 lần / connection
+    CACHED_STATEMENTS = 256
+    
+    def __init__(self, db_path, minconn=4, maxconn=32):
         self.db_path = db_path
-        self.init_database()
+        self._idle = queue.LifoQueue(maxsize=maxconn)
+        
+        # Connection ghi mở trước: tạo file database + bật WAL để reader mode=ro đọc được
+        self._write_lock = threading.Lock()
+        self._writer = sqlite3.connect(db_path, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS)
+        # auto_vacuum phải set trước khi tạo bảng (DB cũ cần VACUUM 1 lần mới đổi mode)
+        self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")  # An toàn với WAL, fsync ít hơn
+        self._writer.execute("PRAGMA journal_size_limit=67108864")  # Cắt file WAL về <= 64MB sau checkpoint
+        self._writer.execute("PRAGMA foreign_keys=ON")
+        self._apply_pragmas(self._writer)
+        
+        self._read_uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+        
+        # Prewarm
+        for _ in range(minconn):
+            self._idle.put_nowait(self._connect())
     
-    def get_connection(self):
-        """Tạo kết nối tới database"""
-        return sqlite3.connect(self.db_path)
+    def _apply_pragmas(self, conn):
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
     
-    def init_database(self):
+    def _connect(self):
+        """Mở connection chỉ đọc mới"""
+        conn = sqlite3.connect(
+            self._read_uri, uri=True, check_same_thread=False,
+            factory=PooledConnection, cached_statements=self.CACHED_STATEMENTS
+        )
+        conn.pool = self
+        conn.row_factory = sqlite3.Row  # C-level row, dict(row) không cần vòng lặp Python
+        self._apply_pragmas(conn)
+        return conn
+    
+    def acquire(self):
+        """Lấy 1 connection đọc từ pool (hoặc mở mới nếu pool rỗng)"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+    
+    def release(self, conn):
+        """Trả connection về pool, rollback transaction còn dang dở"""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            sqlite3.Connection.close(conn)
+    
+    @contextmanager
+    def connection(self):
         """
-        Tạo các bảng cần thiết nếu chưa tồn tại
+        Usage:
+            with db.pool.connection() as conn:
+                conn.execute("SELECT 1")
         """
-        conn = self.get_connection()
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    
+    @contextmanager
+    def read(self):
+        """
+        Cursor trên connection chỉ đọc
+        Usage:
+            with db.pool.read() as cursor:
+                cursor.execute("SELECT ...")
+        """
+        conn = self.acquire()
         cursor = conn.cursor()
-        
-        # Bảng 1: Users - Lưu thông tin đăng ký
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT UNIQUE NOT NULL,
-                username TEXT,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'user',
-                verified INTEGER DEFAULT 0,
-                verification_token TEXT,
-                oauth_refresh_token TEXT,
-                oauth_access_token TEXT,
-                oauth_token_expiry TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Bảng 2: Conversations - Danh sách cuộc hội thoại
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT NOT NULL,
-                contact_email TEXT NOT NULL,
-                last_message TEXT,
-                last_timestamp TIMESTAMP,
-                unread_count INTEGER DEFAULT 0,
-                UNIQUE(user_email, contact_email)
-            )
-        """)
-        
-        # Bảng 3: Messages - Lưu tin nhắn chi tiết
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT UNIQUE,
-                conversation_id INTEGER,
-                sender TEXT NOT NULL,
-                recipient TEXT NOT NULL,
-                subject TEXT,
-                body TEXT,
-                is_encrypted BOOLEAN DEFAULT 0,
-                is_file BOOLEAN DEFAULT 0,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(conversation_id) REFERENCES conversations(id)
-            )
-        """)
-        
-        # Bảng 4: OAuth Tokens - Lưu OAuth tokens từ Google
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS oauth_tokens (
-                user_email TEXT PRIMARY KEY,
-                access_token TEXT,
-                refresh_token TEXT,
-                token_expiry TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_email) REFERENCES users(email)
-            )
-        """)
-        
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self.release(conn)
+    
+    @contextmanager
+    def write(self):
+        """
+        Cursor trên connection ghi (giữ write lock cho tới khi ra khỏi block)
+        Commit khi block kết thúc bình thường, rollback nếu có exception
+        """
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            try:
+                # Lấy RESERVED lock ngay từ đầu → các instance khác dùng chung file chờ busy timeout
+                # thay vì deadlock khi nâng cấp từ read lên write giữa transaction
+                cursor.execute("BEGIN IMMEDIATE")
+                yield cursor
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+            finally:
+                cursor.close()
+    
+    def incremental_vacuum(self, pages=128000):
+        """Trả lại tối đa `pages` trang trống cho filesystem (cần auto_vacuum=INCREMENTAL)"""
+        with self._write_lock:
+            self._writer.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            self._writer.commit()
+    
+    def close_all(self):
+        """Đóng hẳn connection ghi và tất cả connection đang rảnh"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            sqlite3.Connection.close(conn)
+        with self._write_lock:
+            self._writer.close()
+
+
+class Database:
+    # Lookup tables: {tên bảng: (schema, cột cần copy khi migrate)}
+    LOOKUP_TABLES = {
         # Bảng 5: User Keys - Lưu public keys cho E2EE
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_keys (
+        'user_keys': ("""(
                 user_email TEXT PRIMARY KEY,
                 public_key TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(user_email) REFERENCES users(email)
-            )
-        """)
-        
+            ) WITHOUT ROWID""",
+            "user_email, public_key, created_at, updated_at"),
         # Bảng 6: Permissions - RBAC system
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS permissions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+        'permissions': ("""(
                 role TEXT NOT NULL,
                 resource TEXT NOT NULL,
                 action TEXT NOT NULL,
-                UNIQUE(role, resource, action)
-            )
-        """)
-        
-        # Insert default permissions
-        cursor.execute("SELECT COUNT(*) FROM permissions")
-        if cursor.fetchone()[0] == 0:
-            default_permissions = [
-                # Admin permissions
-                ('admin', '*', '*'),
-                ('admin', 'users', 'view_all'),
-                ('admin', 'users', 'delete'),
-                ('admin', 'users', 'edit'),
-                ('admin', 'messages', 'view_all'),
-                ('admin', 'messages', 'delete'),
-                ('admin', 'database', 'export'),
-                ('admin', 'database', 'backup'),
-                ('admin', 'system', 'stats'),
-                # User permissions
-                ('user', 'messages', 'send'),
-                ('user', 'messages', 'read_own'),
-                ('user', 'profile', 'edit_own'),
-                ('user', 'users', 'list'),
-            ]
-            cursor.executemany("""
-                INSERT INTO permissions (role, resource, action) VALUES (?, ?, ?)
-            """, default_permissions)
-            print("[DB] Default permissions created")
+                PRIMARY KEY(role, resource, action)
+            ) WITHOUT ROWID""",
+            "role, resource, action"),
+    }
+    
+    def __init__(self, db_path="delta_chat.db"):
+        """
+        Khởi tạo Database SQLite cho Delta Chat
+        """
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        self._vacuum_stop = threading.Event()
         
-        conn.commit()
+        # {stored_hash: (HMAC(password), expires_at)} - key HMAC ngẫu nhiên mỗi process,
+        # không lưu password/hash nhanh có thể brute-force offline
+        self._verify_cache = {}
+        self._verify_key = os.urandom(32)
+        self.init_database()
+    
+    def start_incremental_vacuum(self, interval=900, pages=128000):
+        """Chạy PRAGMA incremental_vacuum định kỳ (mặc định 15 phút) trong background thread"""
+        def loop():
+            while not self._vacuum_stop.wait(interval):
+                try:
+                    self.pool.incremental_vacuum(pages)
+                except sqlite3.Error as e:
+                    print(f"[DB] Incremental vacuum failed: {e}")
         
-        # Migration: Add user_id column if not exists
-        try:
-            cursor.execute("SELECT user_id FROM users LIMIT 1")
-        except sqlite3.OperationalError:
+        threading.Thread(target=loop, daemon=True, name='db-vacuum').start()
+    
+    def stop_incremental_vacuum(self):
+        self._vacuum_stop.set()
+    
+    def init_database(self):
+        """
+        Tạo các bảng cần thiết nếu chưa tồn tại
+        """
+        with self.pool.write() as cursor:
+            # Bảng 1: Users - Lưu thông tin đăng ký
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT UNIQUE NOT NULL,
+                    username TEXT,
+                    email TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    role TEXT DEFAULT 'user',
+                    verified INTEGER DEFAULT 0,
+                    verification_token TEXT,
+                    oauth_refresh_token TEXT,
+                    oauth_access_token TEXT,
+                    oauth_token_expiry TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Bảng 2: Conversations - Danh sách cuộc hội thoại
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT NOT NULL,
+                    contact_email TEXT NOT NULL,
+                    last_message TEXT,
+                    last_timestamp TIMESTAMP,
+                    unread_count INTEGER DEFAULT 0,
+                    UNIQUE(user_email, contact_email)
+                )
+            """)
+            
+            # Bảng 3: Messages - Lưu tin nhắn chi tiết
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT UNIQUE,
+                    conversation_id INTEGER,
+                    sender TEXT NOT NULL,
+                    recipient TEXT NOT NULL,
+                    subject TEXT,
+                    body TEXT,
+                    is_encrypted BOOLEAN DEFAULT 0,
+                    is_file BOOLEAN DEFAULT 0,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY(conversation_id) REFERENCES conversations(id)
+                )
+            """)
+            
+            # Bảng 4-6: lookup tables theo natural key → WITHOUT ROWID (1 B-tree, không có rowid)
+            for table, (schema, columns) in self.LOOKUP_TABLES.items():
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} {schema}")
+            
+            # Indexes cho các query nóng (UNIQUE đã có sẵn index cho users.email/user_id,
+            # permissions(role, resource, action) và conversations(user_email, contact_email))
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_ts ON messages(conversation_id, timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages(sender, timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient_ts ON messages(recipient, timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conv_user_ts ON conversations(user_email, last_timestamp DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conv_contact ON conversations(contact_email)")
+            # Covering index: GROUP BY role (đếm user theo role) chỉ đọc trang index, không đọc từng dòng users
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
+            # Partial index: COUNT tin mã hóa (admin stats) chỉ quét các dòng khớp, không quét cả bảng
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_encrypted ON messages(timestamp) WHERE is_encrypted = 1")
+            
+            # Insert default permissions
+            cursor.execute("SELECT COUNT(*) FROM permissions")
+            if cursor.fetchone()[0] == 0:
+                default_permissions = [
+                    # Admin permissions
+                    ('admin', '*', '*'),
+                    ('admin', 'users', 'view_all'),
+                    ('admin', 'users', 'delete'),
+                    ('admin', 'users', 'edit'),
+                    ('admin', 'messages', 'view_all'),
+                    ('admin', 'messages', 'delete'),
+                    ('admin', 'database', 'export'),
+                    ('admin', 'database', 'backup'),
+                    ('admin', 'system', 'stats'),
+                    # User permissions
+                    ('user', 'messages', 'send'),
+                    ('user', 'messages', 'read_own'),
+                    ('user', 'profile', 'edit_own'),
+                    ('user', 'users', 'list'),
+                ]
+                cursor.executemany("""
+                    INSERT INTO permissions (role, resource, action) VALUES (?, ?, ?)
+                """, default_permissions)
+                print("[DB] Default permissions created")
+        
+        # Migrations theo PRAGMA user_version: đọc version + migrate + bump trong cùng 1 transaction ghi
+        # (BEGIN IMMEDIATE, ~EXCLUSIVE trong WAL) → nhiều instance khởi động cùng lúc không migrate 2 lần
+        with self.pool.write() as cursor:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                for target, migrate in self._migrations():
+                    if version < target:
+                        migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                print(f"[DB] Schema version {version} → {SCHEMA_VERSION}")
+        
+        self.reload_permissions()
+        print("[DB] Database initialized successfully.")
+    
+    def _migrations(self):
+        """Danh sách (version đích, hàm migrate); DB mới tạo ở version 0 chạy qua hết nhưng đều là no-op"""
+        return [
+            (1, self._migrate_add_user_id),
+            (2, self._migrate_lookup_without_rowid),
+            (3, self._migrate_merge_oauth_tokens),
+        ]
+    
+    def _migrate_add_user_id(self, cursor):
+        """v1: Add user_id column if not exists"""
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+        if 'user_id' not in columns:
             print("[DB] Migrating: Adding user_id column...")
             cursor.execute("ALTER TABLE users ADD COLUMN user_id TEXT")
             
             # Generate user_ids for existing users
-            cursor.execute("SELECT id, email FROM users WHERE user_id IS NULL")
-            existing_users = cursor.fetchall()
-            
-            for user_id, email in existing_users:
-                new_user_id = self.generate_user_id(email)
-                cursor.execute("UPDATE users SET user_id = ? WHERE id = ?", (new_user_id, user_id))
-                print(f"[DB] Generated user_id for {email}: {new_user_id}")
-            
-            conn.commit()
-            print("[DB] Migration completed!")
+            cursor.execute("SELECT id FROM users WHERE user_id IS NULL")
+            pairs = [(self.generate_user_id(), row_id) for (row_id,) in cursor.fetchall()]
+            cursor.executemany("UPDATE users SET user_id = ? WHERE id = ?", pairs)
+            print(f"[DB] Generated user_id for {len(pairs)} users")
         
-        conn.close()
-        print("[DB] Database initialized successfully.")
+        # ALTER TABLE ADD COLUMN không thêm được UNIQUE → tạo index riêng cho DB đã migrate
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)")
+    
+    def _migrate_lookup_without_rowid(self, cursor):
+        """v2: Chuyển lookup tables cũ (rowid) sang WITHOUT ROWID bằng clone-and-rename"""
+        for table, (schema, columns) in self.LOOKUP_TABLES.items():
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if 'WITHOUT ROWID' in cursor.fetchone()[0].upper():
+                continue
+            print(f"[DB] Migrating: {table} → WITHOUT ROWID...")
+            cursor.execute(f"CREATE TABLE {table}_new {schema}")
+            cursor.execute(f"INSERT OR IGNORE INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+            cursor.execute(f"DROP TABLE {table}")
+            cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    
+    def _migrate_merge_oauth_tokens(self, cursor):
+        """v3: Gộp bảng oauth_tokens cũ vào users.oauth_* (chỉ giữ 1 nơi lưu token)"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'oauth_tokens'")
+        if not cursor.fetchone():
+            return
+        print("[DB] Migrating: oauth_tokens → users.oauth_*...")
+        cursor.execute("""
+            UPDATE users SET
+                oauth_access_token = COALESCE(oauth_access_token,
+                    (SELECT access_token FROM oauth_tokens WHERE user_email = users.email)),
+                oauth_refresh_token = COALESCE(oauth_refresh_token,
+                    (SELECT refresh_token FROM oauth_tokens WHERE user_email = users.email)),
+                oauth_token_expiry = COALESCE(oauth_token_expiry,
+                    (SELECT token_expiry FROM oauth_tokens WHERE user_email = users.email))
+            WHERE email IN (SELECT user_email FROM oauth_tokens)
+        """)
+        cursor.execute("DROP TABLE oauth_tokens")
     
     def hash_password(self, password):
         """
         Mã hóa mật khẩu bằng PBKDF2-HMAC-SHA256 với salt
-        Format: salt$hash (hex)
+        Format: base64(salt 16 bytes + hash 32 bytes) — 64 ký tự, format cũ salt$hash (hex) vẫn verify được
         """
-        import secrets
-        
-        # Generate random 16-byte salt
-        salt = secrets.token_hex(16)  # 32 chars hex
+        # Generate random 16-byte salt (raw bytes, đủ 128 bit entropy)
+        salt = secrets.token_bytes(SALT_SIZE)
         
         # PBKDF2 with 100,000 iterations
-        pwd_hash = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt.encode('utf-8'),
-            100000  # iterations
-        )
+        pwd_hash = self._pbkdf2(password, salt)
         
-        # Return format: salt$hash
-        return f"{salt}${pwd_hash.hex()}"
+        return base64.b64encode(salt + pwd_hash).decode('ascii')
     
-    def generate_user_id(self, email):
+    @staticmethod
+    def _pbkdf2(password, salt):
         """
-        Tạo User ID duy nhất từ email + salt
-        Format: 12 ký tự hex (a3f4e8b9c2d1)
+        PBKDF2-HMAC-SHA256 qua cryptography (OpenSSL EVP, SHA-NI/ARMv8 nếu có)
+        Output giống hệt hashlib.pbkdf2_hmac
         
         Args:
-            email: Email của user
-            
-        Returns:
-            str: User ID (12 chars)
+            salt: bytes (format mới) hoặc str hex (format cũ salt$hash, dùng nguyên chuỗi ASCII làm salt)
         """
-        import secrets
-        import time
-        
-        # Tạo deterministic ID từ email + timestamp
-        # Để ID không đổi nhưng vẫn unpredictable
-        salt = str(int(time.time() * 1000000))  # microseconds
-        
-        # SHA256 hash
-        hash_obj = hashlib.sha256((email + salt).encode())
-        hash_hex = hash_obj.hexdigest()
+        if isinstance(salt, str):
+            salt = salt.encode('utf-8')
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=PBKDF2_ITERATIONS
+        )
+        return kdf.derive(password.encode('utf-8'))
+    
+    @staticmethod
+    def generate_user_id():
+        """
+        Tạo User ID ngẫu nhiên từ CSPRNG của OS
+        Format: 16 ký tự hex (64 bit, a3f4e8b9c2d1e0f7)
+        ID cũ 12 ký tự vẫn hợp lệ; UNIQUE index trên users.user_id chặn trùng
         
-        # Lấy 12 ký tự đầu
-        return hash_hex[:12]
+        Returns:
+            str: User ID (16 chars)
+        """
+        return secrets.token_hex(USER_ID_BYTES)
     
     def verify_password(self, password, stored_hash):
         """
@@ -206,31 +450,47 @@ class Database:
         
         Args:
             password: Mật khẩu plaintext
-            stored_hash: Hash từ database (salt$hash)
+            stored_hash: Hash từ database (base64 hoặc salt$hash cũ)
         
         Returns:
             bool: True nếu match
         """
-        try:
-            # Parse salt and hash
-            salt, pwd_hash = stored_hash.split('$')
-            
-            # Compute hash with same salt
-            check_hash = hashlib.pbkdf2_hmac(
-                'sha256',
-                password.encode('utf-8'),
-                salt.encode('utf-8'),
-                100000
-            )
-            
-            # Compare
-            return check_hash.hex() == pwd_hash
-        except:
-            # Fallback: Old SHA-256 format (for backward compatibility)
+        # Fast path: đã verify thành công gần đây (key theo stored_hash → đổi mật khẩu là tự mất cache)
+        digest = hmac.new(self._verify_key, password.encode('utf-8'), hashlib.sha3_256).digest()
+        cached = self._verify_cache.get(stored_hash)
+        if cached and cached[1] > time.monotonic() and hmac.compare_digest(cached[0], digest):
+            return True
+        
+        if self._verify_password_slow(password, stored_hash):
+            self._verify_cache[stored_hash] = (digest, time.monotonic() + VERIFY_CACHE_TTL)
+            return True
+        return False
+    
+    def _verify_password_slow(self, password, stored_hash):
+        """PBKDF2 verify đầy đủ (kèm fallback salt$hash hex và SHA-256 format cũ)"""
+        if len(stored_hash) == 64 and all(c in '0123456789abcdef' for c in stored_hash):
+            # Format cũ nhất: SHA-256 hex không salt (64 ký tự hex cũng là base64 hợp lệ nên phải check trước)
             old_hash = hashlib.sha256(password.encode()).hexdigest()
-            return old_hash == stored_hash
+            return hmac.compare_digest(old_hash, stored_hash)
+        
+        # Chỉ phần parse nằm trong try: hash hỏng → False ngay, không tốn 1 lần PBKDF2 / SHA-256 nào
+        try:
+            if '$' in stored_hash:
+                # Format cũ: salt$hash (hex)
+                salt, pwd_hash = stored_hash.split('$')
+                pwd_hash = bytes.fromhex(pwd_hash)
+            else:
+                blob = base64.b64decode(stored_hash, validate=True)
+                salt, pwd_hash = blob[:SALT_SIZE], blob[SALT_SIZE:]
+        except (ValueError, binascii.Error):
+            return False
+        if len(pwd_hash) != 32:
+            return False
+        
+        # Compute hash with same salt, so sánh constant-time
+        return hmac.compare_digest(self._pbkdf2(password, salt), pwd_hash)
     
-    def register_user(self, username, email, password, role='user'):
+    def register_user(self, username, email, password, role='user', public_key=None):
         """
         Đăng ký user mới
         
@@ -239,30 +499,37 @@ class Database:
             email: Email (unique)
             password: Mật khẩu plaintext
             role: 'admin' hoặc 'user' (default: 'user')
+            public_key: E2EE public key (PEM), lưu luôn trong cùng transaction (1 commit thay vì 2)
         
         Returns:
             dict: {'success': True, 'user_id': 'xxx'} hoặc {'success': False}
         """
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            password_hash = self.hash_password(password)
-            user_id = self.generate_user_id(email)
-            
-            cursor.execute("""
-                INSERT INTO users (user_id, username, email, password_hash, role, verified)
-                VALUES (?, ?, ?, ?, ?, 1)
-            """, (user_id, username, email, password_hash, role))
-            
-            conn.commit()
-            conn.close()
-            
-            print(f"[DB] ✅ Created user: {email} → User ID: {user_id}")
-            return {'success': True, 'user_id': user_id}
-        except sqlite3.IntegrityError as e:
-            print(f"[DB] ❌ Registration failed: {e}")
-            return {'success': False, 'error': 'Email already exists'}
+        password_hash = self.hash_password(password)
+        
+        for _ in range(USER_ID_RETRIES):
+            user_id = self.generate_user_id()
+            try:
+                with self.pool.write() as cursor:
+                    cursor.execute("""
+                        INSERT INTO users (user_id, username, email, password_hash, role, verified)
+                        VALUES (?, ?, ?, ?, ?, 1)
+                    """, (user_id, username, email, password_hash, role))
+                    if public_key is not None:
+                        cursor.execute("""
+                            INSERT OR REPLACE INTO user_keys (user_email, public_key, updated_at)
+                            VALUES (?, ?, CURRENT_TIMESTAMP)
+                        """, (email, public_key))
+                
+                print(f"[DB] ✅ Created user: {email} → User ID: {user_id}")
+                return {'success': True, 'user_id': user_id}
+            except sqlite3.IntegrityError as e:
+                if 'user_id' in str(e):
+                    continue  # Trùng user_id (cực hiếm) → sinh ID khác
+                print(f"[DB] ❌ Registration failed: {e}")
+                return {'success': False, 'error': 'Email already exists'}
+        
+        print(f"[DB] ❌ Registration failed: could not allocate unique user_id for {email}")
+        return {'success': False, 'error': 'Could not generate user ID'}
     
     def login_user(self, email, password):
         """
@@ -273,20 +540,18 @@ class Database:
             password: Mật khẩu plaintext
         
         Returns:
-            dict: User info nếu thành công, None nếu thất bại
+            dict: User info (kèm oauth_tokens) nếu thành công, None nếu thất bại
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Get user by email
-        cursor.execute("""
-            SELECT id, username, email, password_hash, role
-            FROM users
-            WHERE email = ?
-        """, (email,))
-        
-        user = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            # Get user by email (lấy luôn OAuth tokens, khỏi query lần 2)
+            cursor.execute("""
+                SELECT id, username, email, password_hash, role,
+                       oauth_access_token, oauth_refresh_token, oauth_token_expiry
+                FROM users
+                WHERE email = ?
+            """, (email,))
+            
+            user = cursor.fetchone()
         
         if user:
             # Verify password
@@ -295,44 +560,67 @@ class Database:
                     "id": user[0],
                     "username": user[1],
                     "email": user[2],
-                    "role": user[4]
+                    "role": user[4],
+                    "oauth_tokens": self._oauth_tokens_from_row(user[5:8])
                 }
         
         return None
     
     # Gmail App Password methods removed - using TCP sockets instead
     
+    def _get_or_create_conversation(self, cursor, user_email, contact_email):
+        """Như get_or_create_conversation nhưng chạy trên cursor ghi đang mở"""
+        if HAS_UPSERT_RETURNING:
+            # 1 câu lệnh: insert nếu chưa có, luôn trả về id (DO UPDATE no-op để RETURNING có row)
+            cursor.execute("""
+                INSERT INTO conversations (user_email, contact_email)
+                VALUES (?, ?)
+                ON CONFLICT(user_email, contact_email) DO UPDATE SET contact_email = excluded.contact_email
+                RETURNING id
+            """, (user_email, contact_email))
+            return cursor.fetchone()[0]
+        
+        # SQLite < 3.35: không có RETURNING
+        cursor.execute("""
+            INSERT OR IGNORE INTO conversations (user_email, contact_email)
+            VALUES (?, ?)
+        """, (user_email, contact_email))
+        cursor.execute("""
+            SELECT id FROM conversations
+            WHERE user_email = ? AND contact_email = ?
+        """, (user_email, contact_email))
+        return cursor.fetchone()[0]
+    
     def get_or_create_conversation(self, user_email, contact_email):
         """
         Lấy hoặc tạo mới conversation
         :return: conversation_id
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Tìm conversation hiện có
-        cursor.execute("""
-            SELECT id FROM conversations
-            WHERE user_email = ? AND contact_email = ?
-        """, (user_email, contact_email))
-        
-        conv = cursor.fetchone()
-        
-        if conv:
-            conn.close()
-            return conv[0]
-        
-        # Tạo mới nếu chưa có
-        cursor.execute("""
-            INSERT INTO conversations (user_email, contact_email)
-            VALUES (?, ?)
-        """, (user_email, contact_email))
-        
-        conversation_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return conversation_id
+        with self.pool.write() as cursor:
+            return self._get_or_create_conversation(cursor, user_email, contact_email)
+    
+    def has_conversation(self, email_a, email_b):
+        """Check đã có conversation giữa 2 user chưa (theo cả 2 chiều)"""
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM conversations
+                WHERE (user_email = ? AND contact_email = ?)
+                   OR (user_email = ? AND contact_email = ?)
+                LIMIT 1
+            """, (email_a, email_b, email_b, email_a))
+            
+            return cursor.fetchone() is not None
+    
+    def get_contact_emails(self, user_email):
+        """Lấy email của tất cả người đã có conversation với user (cả 2 chiều)"""
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT contact_email FROM conversations WHERE user_email = ?
+                UNION
+                SELECT user_email FROM conversations WHERE contact_email = ?
+            """, (user_email, user_email))
+            
+            return [row[0] for row in cursor.fetchall()]
     
     def save_message(self, message_id, sender, recipient, subject, body, is_encrypted=False, is_file=False):
         """
@@ -340,235 +628,253 @@ class Database:
         :return: True nếu tin nhắn mới, False nếu đã tồn tại
         """
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with self.pool.write() as cursor:
+                # Xác định conversation (người gửi hoặc người nhận là user hiện tại)
+                # Logic: Lấy email nhỏ hơn làm user_email, lớn hơn làm contact_email
+                emails = sorted([sender, recipient])
+                conv_id = self._get_or_create_conversation(cursor, emails[0], emails[1])
+                
+                cursor.execute("""
+                    INSERT INTO messages (message_id, conversation_id, sender, recipient, subject, body, is_encrypted, is_file)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (message_id, conv_id, sender, recipient, subject, body, is_encrypted, is_file))
+                
+                # Cập nhật last_message trong conversation
+                cursor.execute("""
+                    UPDATE conversations
+                    SET last_message = ?, last_timestamp = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (body[:50] + "..." if len(body) > 50 else body, conv_id))
             
-            # Xác định conversation (người gửi hoặc người nhận là user hiện tại)
-            # Logic: Lấy email nhỏ hơn làm user_email, lớn hơn làm contact_email
-            emails = sorted([sender, recipient])
-            conv_id = self.get_or_create_conversation(emails[0], emails[1])
+            return True
+        
+        except sqlite3.IntegrityError:
+            return False  # Tin nhắn đã tồn tại
+    
+    def save_messages(self, messages):
+        """
+        Lưu nhiều tin nhắn trong 1 transaction (bulk sync inbox/queue)
+        :param messages: list tuple (message_id, sender, recipient, subject, body, is_encrypted, is_file)
+        :return: Số tin nhắn mới được lưu (tin đã tồn tại bị bỏ qua)
+        """
+        if not messages:
+            return 0
+        
+        with self.pool.write() as cursor:
+            # 1. Tạo trước mọi conversation còn thiếu (cặp email đã sort như save_message)
+            pairs = {tuple(sorted((msg[1], msg[2]))) for msg in messages}
+            cursor.executemany("""
+                INSERT OR IGNORE INTO conversations (user_email, contact_email)
+                VALUES (?, ?)
+            """, pairs)
             
-            cursor.execute("""
+            conv_ids = {}
+            for pair in pairs:
+                cursor.execute("""
+                    SELECT id FROM conversations
+                    WHERE user_email = ? AND contact_email = ?
+                """, pair)
+                conv_ids[pair] = cursor.fetchone()[0]
+            
+            # 2. Bỏ tin đã có trong DB (hoặc lặp trong batch) → last_message chỉ lấy từ tin thật sự mới
+            ids = [msg[0] for msg in messages]
+            seen = set()
+            for start in range(0, len(ids), 500):  # Giới hạn số biến SQL mỗi câu
+                chunk = ids[start:start + 500]
+                cursor.execute(
+                    f"SELECT message_id FROM messages WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                seen.update(row[0] for row in cursor.fetchall())
+            
+            # 3. Insert toàn bộ tin nhắn mới
+            rows = []
+            last_message = {}  # conv_id -> body của tin cuối trong batch
+            for message_id, sender, recipient, subject, body, is_encrypted, is_file in messages:
+                if message_id in seen:
+                    continue
+                seen.add(message_id)
+                conv_id = conv_ids[tuple(sorted((sender, recipient)))]
+                rows.append((message_id, conv_id, sender, recipient, subject, body, is_encrypted, is_file))
+                last_message[conv_id] = body
+            
+            cursor.executemany("""
                 INSERT INTO messages (message_id, conversation_id, sender, recipient, subject, body, is_encrypted, is_file)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (message_id, conv_id, sender, recipient, subject, body, is_encrypted, is_file))
+            """, rows)
             
-            # Cập nhật last_message trong conversation
-            cursor.execute("""
+            # 4. Cập nhật last_message 1 lần cho mỗi conversation
+            cursor.executemany("""
                 UPDATE conversations
                 SET last_message = ?, last_timestamp = CURRENT_TIMESTAMP
                 WHERE id = ?
-            """, (body[:50] + "..." if len(body) > 50 else body, conv_id))
-            
-            conn.commit()
-            conn.close()
-            return True
+            """, [
+                (body[:50] + "..." if len(body) > 50 else body, conv_id)
+                for conv_id, body in last_message.items()
+            ])
+        
+        return len(rows)
+    
+    def update_message_body(self, message_id, body):
+        """
+        Cập nhật body của tin nhắn đã lưu (vd: thay placeholder bằng URL file sau khi upload xong)
+        :return: True nếu có tin nhắn được cập nhật
+        """
+        with self.pool.write() as cursor:
+            cursor.execute("""
+                UPDATE messages SET body = ? WHERE message_id = ?
+            """, (body, message_id))
             
-        except sqlite3.IntegrityError:
-            return False  # Tin nhắn đã tồn tại
+            return cursor.rowcount > 0
     
     def get_conversations(self, user_email):
         """
         Lấy danh sách cuộc hội thoại của user
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, contact_email, last_message, last_timestamp, unread_count
-            FROM conversations
-            WHERE user_email = ?
-            ORDER BY last_timestamp DESC
-        """, (user_email,))
-        
-        conversations = []
-        for row in cursor.fetchall():
-            conversations.append({
-                "id": row[0],
-                "contact": row[1],
-                "last_message": row[2],
-                "last_timestamp": row[3],
-                "unread_count": row[4]
-            })
-        
-        conn.close()
-        return conversations
-    
-    def get_messages_by_conversation(self, conversation_id, limit=50):
-        """
-        Lấy tin nhắn trong 1 cuộc hội thoại
-        """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT id, contact_email AS contact, last_message, last_timestamp, unread_count
+                FROM conversations
+                WHERE user_email = ?
+                ORDER BY last_timestamp DESC
+            """, (user_email,))
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @staticmethod
+    def _db_timestamp(timestamp):
+        """Cursor phân trang: nhận cả ISO ('...T...Z') lẫn format SQLite ('YYYY-MM-DD HH:MM:SS')"""
+        return timestamp.rstrip('Z').replace('T', ' ')
+    
+    def iter_messages_by_conversation(self, conversation_id, before_timestamp=None, before_id=None, limit=50):
+        """
+        Generator: stream 1 trang tin nhắn trong 1 cuộc hội thoại (keyset pagination)
+        Trang đầu là limit tin mới nhất; trang sau truyền (timestamp, id) của tin cũ nhất trang trước.
+        Mỗi trang là 1 lần seek B-tree trên idx_messages_conv_ts thay vì quét OFFSET.
+        Kết quả vẫn theo thứ tự thời gian tăng dần.
+        """
+        if before_timestamp is None:
+            where, params = "", ()
+        elif before_id is None:
+            where, params = "AND timestamp < ?", (self._db_timestamp(before_timestamp),)
+        else:
+            # (timestamp, id) để không bỏ sót tin cùng giây ở ranh giới trang
+            where, params = "AND (timestamp, id) < (?, ?)", (self._db_timestamp(before_timestamp), before_id)
+        
+        with self.pool.read() as cursor:
+            cursor.execute(f"""
+                SELECT id, message_id, sender, recipient, subject, body, is_encrypted, is_file, timestamp
+                FROM messages
+                WHERE conversation_id = ? {where}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            """, (conversation_id, *params, limit))
+            
+            # Trang tối đa limit dòng → đảo lại cho đúng thứ tự hiển thị
+            page = cursor.fetchall()
         
-        cursor.execute("""
-            SELECT message_id, sender, recipient, subject, body, is_encrypted, is_file, timestamp
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY timestamp ASC
-            LIMIT ?
-        """, (conversation_id, limit))
-        
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                "message_id": row[0],
-                "sender": row[1],
-                "recipient": row[2],
-                "subject": row[3],
-                "body": row[4],
-                "is_encrypted": row[5],
-                "is_file": row[6],
-                "timestamp": row[7]
-            })
-        
-        conn.close()
-        return messages
-    
-    def get_all_messages_for_user(self, user_email, limit=100):
-        """
-        Lấy TẤT CẢ tin nhắn liên quan đến user (gửi hoặc nhận)
-        """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        for row in reversed(page):
+            yield dict(row)
+    
+    def get_messages_by_conversation(self, conversation_id, before_timestamp=None, before_id=None, limit=50):
+        """
+        Lấy 1 trang tin nhắn trong 1 cuộc hội thoại
+        Cursor trang tiếp theo: (page[0]['timestamp'], page[0]['id'])
+        """
+        return list(self.iter_messages_by_conversation(conversation_id, before_timestamp, before_id, limit))
+    
+    def iter_messages_for_user(self, user_email, before_timestamp=None, before_id=None, limit=100):
+        """
+        Generator: stream 1 trang tin nhắn liên quan đến user (gửi hoặc nhận), keyset pagination
+        như iter_messages_by_conversation
+        """
+        if before_timestamp is None:
+            where, cursor_params = "", ()
+        elif before_id is None:
+            where, cursor_params = "AND timestamp < ?", (self._db_timestamp(before_timestamp),)
+        else:
+            where, cursor_params = "AND (timestamp, id) < (?, ?)", (self._db_timestamp(before_timestamp), before_id)
+        
+        with self.pool.read() as cursor:
+            # UNION ALL thay cho OR để mỗi nhánh dùng index riêng (sender / recipient)
+            # Nhánh 2 bỏ tin tự gửi cho chính mình để không bị trùng
+            cursor.execute(f"""
+                SELECT id, message_id, sender, recipient, subject, body, is_encrypted, is_file, timestamp
+                FROM messages
+                WHERE sender = ? {where}
+                UNION ALL
+                SELECT id, message_id, sender, recipient, subject, body, is_encrypted, is_file, timestamp
+                FROM messages
+                WHERE recipient = ? AND sender != ? {where}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            """, (user_email, *cursor_params, user_email, user_email, *cursor_params, limit))
+            
+            page = cursor.fetchall()
         
-        cursor.execute("""
-            SELECT message_id, sender, recipient, subject, body, is_encrypted, is_file, timestamp
-            FROM messages
-            WHERE sender = ? OR recipient = ?
-            ORDER BY timestamp ASC
-            LIMIT ?
-        """, (user_email, user_email, limit))
-        
-        messages = []
-        for row in cursor.fetchall():
+        for row in reversed(page):
+            msg = dict(row)
+            
             # Convert SQLite timestamp to ISO format for JavaScript
-            timestamp = row[7]
+            timestamp = msg['timestamp']
             if timestamp:
                 try:
-                    from datetime import datetime
                     # SQLite CURRENT_TIMESTAMP format: 'YYYY-MM-DD HH:MM:SS'
                     dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                    timestamp = dt.isoformat() + 'Z'  # ISO 8601 format
-                except:
+                    msg['timestamp'] = dt.isoformat() + 'Z'  # ISO 8601 format
+                except ValueError:
                     pass  # Keep original if conversion fails
             
-            messages.append({
-                "message_id": row[0],
-                "sender": row[1],
-                "recipient": row[2],
-                "subject": row[3],
-                "body": row[4],
-                "is_encrypted": row[5],
-                "is_file": row[6],
-                "timestamp": timestamp
-            })
-        
-        conn.close()
-        return messages
+            yield msg
     
-    def save_oauth_tokens(self, email, access_token, refresh_token, token_expiry):
-        """
-        Lưu OAuth tokens vào database
+    def get_all_messages_for_user(self, user_email, before_timestamp=None, before_id=None, limit=100):
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO oauth_tokens 
-            (user_email, access_token, refresh_token, token_expiry, updated_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (email, access_token, refresh_token, token_expiry))
-        
-        conn.commit()
-        conn.close()
-
-    def get_oauth_tokens(self, email):
+        Lấy 1 trang tin nhắn liên quan đến user (gửi hoặc nhận)
         """
-        Lấy OAuth tokens từ database
-        """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT access_token, refresh_token, token_expiry
-            FROM oauth_tokens
-            WHERE user_email = ?
-        """, (email,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            return {
-                'access_token': result[0],
-                'refresh_token': result[1],
-                'token_expiry': result[2]
-            }
-        return None
+        return list(self.iter_messages_for_user(user_email, before_timestamp, before_id, limit))
     
     def save_public_key(self, email, public_key):
         """
         Lưu public key của user cho E2EE
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_keys (user_email, public_key, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        """, (email, public_key))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.write() as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO user_keys (user_email, public_key, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            """, (email, public_key))
     
     def get_all_users(self):
         """
         Lấy danh sách tất cả users (kể cả user_id)
         Return: List of {id, user_id, username, email}
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, user_id, username, email
-            FROM users
-            ORDER BY username
-        """)
-        
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                'id': row[0],
-                'user_id': row[1],
-                'username': row[2],
-                'email': row[3]
-            })
-        
-        conn.close()
-        return users
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, username, email
+                FROM users
+                ORDER BY username
+            """)
+            
+            return [dict(row) for row in cursor.fetchall()]
     
     def find_user_by_id(self, user_id):
         """
         Tìm user bằng User ID
         
         Args:
-            user_id: User ID (12 chars hex)
-            
+            user_id: User ID (hex, 16 chars; ID cũ 12 chars)
+        
         Returns:
             dict: {id, user_id, username, email} hoặc None
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, user_id, username, email
-            FROM users
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, username, email
+                FROM users
+                WHERE user_id = ?
+            """, (user_id,))
+            
+            result = cursor.fetchone()
         
         if result:
             return {
@@ -585,137 +891,123 @@ class Database:
         
         Args:
             email: Email của user
-            
+        
         Returns:
             str: User ID hoặc None
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT user_id FROM users WHERE email = ?
-        """, (email,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT user_id FROM users WHERE email = ?
+            """, (email,))
+            
+            result = cursor.fetchone()
         
         return result[0] if result else None
-
+    
     def get_public_key(self, email):
         """
         Lấy public key của user
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT public_key FROM user_keys WHERE user_email = ?
-        """, (email,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT public_key FROM user_keys WHERE user_email = ?
+            """, (email,))
+            
+            result = cursor.fetchone()
         
         return result[0] if result else None
     
     def verify_email(self, token):
         """Verify email với token"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE users SET verified = 1, verification_token = NULL
-            WHERE verification_token = ?
-        """, (token,))
-        
-        rows_affected = cursor.rowcount
-        conn.commit()
+        with self.pool.write() as cursor:
+            if HAS_UPSERT_RETURNING:
+                # Trả về đúng user vừa verify, không cần SELECT đoán lại
+                cursor.execute("""
+                    UPDATE users SET verified = 1, verification_token = NULL
+                    WHERE verification_token = ?
+                    RETURNING id, email, username
+                """, (token,))
+                user = cursor.fetchone()
+            else:
+                # SQLite < 3.35: tìm user theo token trước rồi mới update
+                cursor.execute("SELECT id, email, username FROM users WHERE verification_token = ?", (token,))
+                user = cursor.fetchone()
+                if user:
+                    cursor.execute("""
+                        UPDATE users SET verified = 1, verification_token = NULL
+                        WHERE id = ?
+                    """, (user[0],))
         
-        if rows_affected > 0:
-            # Get user info
-            cursor.execute("SELECT id, email, username FROM users WHERE verification_token IS NULL AND verified = 1 ORDER BY id DESC LIMIT 1")
-            user = cursor.fetchone()
-            conn.close()
-            if user:
-                return {'id': user[0], 'email': user[1], 'username': user[2]}
-        
-        conn.close()
+        if user:
+            return {'id': user[0], 'email': user[1], 'username': user[2]}
         return None
     
     def update_oauth_tokens(self, email, access_token, refresh_token, expiry):
         """Lưu OAuth tokens"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE users 
-            SET oauth_access_token = ?, oauth_refresh_token = ?, oauth_token_expiry = ?
-            WHERE email = ?
-        """, (access_token, refresh_token, expiry, email))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.write() as cursor:
+            cursor.execute("""
+                UPDATE users
+                SET oauth_access_token = ?, oauth_refresh_token = ?, oauth_token_expiry = ?
+                WHERE email = ?
+            """, (access_token, refresh_token, expiry, email))
     
     def get_oauth_tokens(self, email):
         """Lấy OAuth tokens"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT oauth_access_token, oauth_refresh_token, oauth_token_expiry
-            FROM users WHERE email = ?
-        """, (email,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT oauth_access_token, oauth_refresh_token, oauth_token_expiry
+                FROM users WHERE email = ?
+            """, (email,))
+            
+            result = cursor.fetchone()
         
-        if result:
-            return {
-                'access_token': result[0],
-                'refresh_token': result[1],
-                'expiry': result[2]
-            }
-        return None
+        return self._oauth_tokens_from_row(result) if result else None
+    
+    @staticmethod
+    def _oauth_tokens_from_row(row):
+        """(access, refresh, expiry) → dict, None nếu user chưa có token"""
+        if row[0] is None and row[1] is None:
+            return None
+        return {
+            'access_token': row[0],
+            'refresh_token': row[1],
+            'expiry': row[2]
+        }
+    
+    def count_users_with_imap(self):
+        """
+        Đếm số user có credentials để sync IMAP (OAuth refresh token cho XOAUTH2)
+        """
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) FROM users WHERE oauth_refresh_token IS NOT NULL
+            """)
+            
+            return cursor.fetchone()[0]
     
     # ===== ADMIN FUNCTIONS =====
     
     def get_all_users_admin(self):
         """Admin: Lấy danh sách tất cả users (với role và created_at)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, user_id, username, email, role, created_at
-            FROM users
-            ORDER BY created_at DESC
-        """)
-        
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                'id': row[0],
-                'user_id': row[1],
-                'username': row[2],
-                'email': row[3],
-                'role': row[4],
-                'created_at': row[5]
-            })
-        
-        conn.close()
-        return users
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, username, email, role, created_at
+                FROM users
+                ORDER BY created_at DESC
+            """)
+            
+            return [dict(row) for row in cursor.fetchall()]
     
     def get_user_by_email(self, email):
         """Lấy thông tin user theo email"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, username, email, role, created_at
-            FROM users
-            WHERE email = ?
-        """, (email,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT id, username, email, role, created_at
+                FROM users
+                WHERE email = ?
+            """, (email,))
+            
+            row = cursor.fetchone()
         
         if row:
             return {
@@ -729,96 +1021,88 @@ class Database:
     
     def delete_user(self, email):
         """Admin: Xóa user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        # Xóa bảng con trước bảng cha (foreign_keys=ON)
+        with self.pool.write() as cursor:
+            # Tách OR thành 2 DELETE để mỗi câu dùng index riêng
+            cursor.execute("DELETE FROM messages WHERE sender = ?", (email,))
+            cursor.execute("DELETE FROM messages WHERE recipient = ?", (email,))
+            cursor.execute("DELETE FROM conversations WHERE user_email = ?", (email,))
+            cursor.execute("DELETE FROM conversations WHERE contact_email = ?", (email,))
+            cursor.execute("DELETE FROM user_keys WHERE user_email = ?", (email,))
+            cursor.execute("DELETE FROM users WHERE email = ?", (email,))
         
-        cursor.execute("DELETE FROM users WHERE email = ?", (email,))
-        cursor.execute("DELETE FROM messages WHERE sender = ? OR recipient = ?", (email, email))
-        cursor.execute("DELETE FROM conversations WHERE user_email = ? OR contact_email = ?", (email, email))
-        cursor.execute("DELETE FROM user_keys WHERE user_email = ?", (email,))
-        
-        conn.commit()
-        conn.close()
         return True
     
     def get_all_messages_admin(self, limit=100):
         """Admin: Lấy tất cả tin nhắn (encrypted)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT message_id, sender, recipient, subject, body, 
-                   is_encrypted, is_file, timestamp
-            FROM messages
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (limit,))
-        
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                'message_id': row[0],
-                'sender': row[1],
-                'recipient': row[2],
-                'subject': row[3],
-                'body': row[4],
-                'is_encrypted': row[5],
-                'is_file': row[6],
-                'timestamp': row[7]
-            })
-        
-        conn.close()
-        return messages
+        with self.pool.read() as cursor:
+            cursor.execute("""
+                SELECT message_id, sender, recipient, subject, body,
+                       is_encrypted, is_file, timestamp
+                FROM messages
+                ORDER BY timestamp DESC
+                LIMIT ?
+            """, (limit,))
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def reload_permissions(self):
+        """
+        Nạp lại bảng permissions vào RAM: {role: {(resource, action)}}
+        Gọi lại sau khi sửa bảng permissions
+        """
+        perms = {}
+        with self.pool.read() as cursor:
+            cursor.execute("SELECT role, resource, action FROM permissions")
+            for role, resource, action in cursor.fetchall():
+                perms.setdefault(role, set()).add((resource, action))
+        
+        # Gán 1 lần → thread khác luôn thấy bản cũ hoặc bản mới hoàn chỉnh
+        self._perms = perms
     
     def has_permission(self, role, resource, action):
-        """Check xem role có permission không"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Check xem role có permission không (tra set trong RAM, không query SQLite)"""
+        perms = self._perms.get(role, ())
         
         # Check wildcard permission
-        cursor.execute("""
-            SELECT COUNT(*) FROM permissions
-            WHERE role = ? AND (
-                (resource = '*' AND action = '*') OR
-                (resource = ? AND action = '*') OR
-                (resource = ? AND action = ?)
-            )
-        """, (role, resource, resource, action))
-        
-        count = cursor.fetchone()[0]
-        conn.close()
-        
-        return count > 0
+        return (
+            ('*', '*') in perms or
+            (resource, '*') in perms or
+            (resource, action) in perms
+        )
     
     def get_database_stats(self):
         """Admin: Lấy thống kê database"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         stats = {}
         
-        # Total users
-        cursor.execute("SELECT COUNT(*) FROM users")
-        stats['total_users'] = cursor.fetchone()[0]
-        
-        # Total messages
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        stats['total_messages'] = cursor.fetchone()[0]
-        
-        # Total conversations
-        cursor.execute("SELECT COUNT(*) FROM conversations")
-        stats['total_conversations'] = cursor.fetchone()[0]
-        
-        # Encrypted messages
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE is_encrypted = 1")
-        stats['encrypted_messages'] = cursor.fetchone()[0]
-        
-        # Users by role
-        cursor.execute("SELECT role, COUNT(*) FROM users GROUP BY role")
-        stats['users_by_role'] = {row[0]: row[1] for row in cursor.fetchall()}
+        with self.pool.read() as cursor:
+            # Total users / messages / conversations / encrypted messages trong 1 câu
+            cursor.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM users) AS total_users,
+                    (SELECT COUNT(*) FROM messages) AS total_messages,
+                    (SELECT COUNT(*) FROM conversations) AS total_conversations,
+                    (SELECT COUNT(*) FROM messages WHERE is_encrypted = 1) AS encrypted_messages
+            """)
+            stats.update(dict(cursor.fetchone()))
+            
+            stats['users_by_role'] = self._users_by_role(cursor)
         
-        conn.close()
         return stats
+    
+    def count_users_by_role(self):
+        """
+        Đếm số user theo role bằng 1 query GROUP BY (thay cho get_all_users() + lọc trong Python)
+        Returns: {'admin': n1, 'user': n2, ...}
+        """
+        with self.pool.read() as cursor:
+            return self._users_by_role(cursor)
+    
+    @staticmethod
+    def _users_by_role(cursor):
+        """SELECT role, COUNT(*) GROUP BY role → dict (dùng idx_users_role)"""
+        cursor.execute("SELECT role, COUNT(*) FROM users GROUP BY role")
+        return {row[0]: row[1] for row in cursor.fetchall()}
 
 
 # TEST CODE
@@ -1,26 +1,90 @@
 import os
-import base64
-from cryptography.hazmat.primitives.asymmetric import ec
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives.asymmetric import ec, x25519
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
 
+# pybase64 optional: codec SIMD (AVX2/AVX-512, chọn theo CPUID lúc chạy), API giống base64 stdlib
+try:
+    import pybase64 as _b64
+    # Trả thẳng str từ C: bỏ 1 lần tạo bytes + .decode('ascii') (đáng kể với tin nhắn ngắn ~100 byte)
+    _b64encode_str = _b64.b64encode_as_string
+except ImportError:
+    import base64 as _b64
+    
+    def _b64encode_str(data):
+        return _b64.b64encode(data).decode('ascii')
+
+# Shared key 1 cặp user không đổi suốt phiên chat → cache để bỏ ECDH + HKDF mỗi tin nhắn
+SHARED_KEY_CACHE_SIZE = 1024
+# Key object đã parse (PEM → ASN.1 chậm), dùng khi miss shared key cache
+KEY_OBJECT_CACHE_SIZE = 256
+# AESGCM object theo key: bỏ key schedule + cấp EVP context mỗi tin nhắn
+AESGCM_CACHE_SIZE = 256
+
+NONCE_SIZE = 12  # 96-bit nonce (khuyến nghị cho GCM)
+NONCE_SPACE = 1 << (8 * NONCE_SIZE)
+TAG_SIZE = 16
+
+
+def _pem_digest(*pems):
+    """Khóa cache: blake2b của PEM, không giữ nguyên văn private key PEM trong cache"""
+    return hashlib.blake2b('|'.join(pems).encode('utf-8'), digest_size=16).digest()
+
+
+class _LRUCache:
+    """LRU nhỏ có lock (get/put từ nhiều request thread)"""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
 class E2EEManager:
     """
     End-to-End Encryption Manager
     Sử dụng ECDH (Elliptic Curve Diffie-Hellman) + AES-GCM-256
     
     Security Features:
-    - ECDH key exchange (secp256r1 / NIST P-256)
+    - ECDH key exchange (secp256r1 / NIST P-256; derive nhận cả keypair X25519)
     - AES-256-GCM authenticated encryption
-    - Random nonce per message
+    - Unique nonce per message (counter, điểm bắt đầu ngẫu nhiên)
     - HKDF key derivation
     """
     
     def __init__(self):
         self.curve = ec.SECP256R1()  # NIST P-256 curve
         self.backend = default_backend()
+        self._shared_keys = _LRUCache(SHARED_KEY_CACHE_SIZE)
+        self._key_objects = _LRUCache(KEY_OBJECT_CACHE_SIZE)
+        self._ciphers = _LRUCache(AESGCM_CACHE_SIZE)
+        # Process fork kế thừa counter nonce → xóa để process con bốc điểm bắt đầu ngẫu nhiên mới
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._ciphers.clear)
         print("[E2EE] ✅ E2EE Manager initialized (ECDH + AES-GCM-256)")
     
     # ===== KEY GENERATION =====
@@ -28,11 +92,23 @@ class E2EEManager:
     def generate_keypair(self):
         """
         Tạo keypair ECDH cho user
+        Vẫn là P-256: user_keys toàn key P-256, keypair X25519 mới không ECDH được với key cũ
+        → chỉ đổi sang X25519 khi có đường xoay key (tạo lại keypair) cho user cũ
         Return: (private_key_pem, public_key_pem)
         """
         # Generate private key
-        private_key = ec.generate_private_key(self.curve, self.backend)
-        
+        return self._serialize_keypair(ec.generate_private_key(self.curve, self.backend))
+    
+    def batch_generate_keypairs(self, n):
+        """
+        Tạo n keypair 1 lượt (provision nhiều user lúc khởi tạo)
+        Return: list (private_key_pem, public_key_pem)
+        """
+        curve, backend = self.curve, self.backend
+        return [self._serialize_keypair(ec.generate_private_key(curve, backend)) for _ in range(n)]
+    
+    def _serialize_keypair(self, private_key):
+        """Key object → (private_pem, public_pem); giữ luôn key object trong cache để derive đầu tiên khỏi parse PEM"""
         # Get public key
         public_key = private_key.public_key()
         
@@ -48,69 +124,126 @@ class E2EEManager:
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         ).decode('utf-8')
         
+        self._key_objects.put(_pem_digest('private', private_pem), private_key)
+        self._key_objects.put(_pem_digest('public', public_pem), public_key)
         return private_pem, public_pem
     
     # ===== KEY EXCHANGE (ECDH) =====
     
     def derive_shared_key(self, my_private_key_pem, their_public_key_pem):
         """
-        Tính shared secret từ ECDH
+        Tính shared secret từ ECDH (cache theo cặp key, LRU)
         Return: 32-byte AES key
         """
-        # Load private key
-        my_private_key = serialization.load_pem_private_key(
-            my_private_key_pem.encode('utf-8'),
-            password=None,
-            backend=self.backend
-        )
+        cache_key = _pem_digest(my_private_key_pem, their_public_key_pem)
+        aes_key = self._shared_keys.get(cache_key)
+        if aes_key is not None:
+            return aes_key
         
-        # Load their public key
-        their_public_key = serialization.load_pem_public_key(
-            their_public_key_pem.encode('utf-8'),
-            backend=self.backend
+        # Load keys (cache key object) rồi ECDH + HKDF
+        aes_key = self.derive_shared_key_obj(
+            self._load_key(my_private_key_pem, private=True),
+            self._load_key(their_public_key_pem, private=False)
         )
         
+        self._shared_keys.put(cache_key, aes_key)
+        return aes_key
+    
+    def derive_shared_key_obj(self, my_private_key, their_public_key):
+        """
+        Như derive_shared_key nhưng nhận key object đã load (load_keypair_once),
+        bỏ hẳn bước parse PEM
+        Return: 32-byte AES key
+        """
         # ECDH: Calculate shared secret
-        shared_secret = my_private_key.exchange(
-            ec.ECDH(),
-            their_public_key
-        )
+        if isinstance(my_private_key, x25519.X25519PrivateKey):
+            if not isinstance(their_public_key, x25519.X25519PublicKey):
+                raise ValueError("Key type mismatch: X25519 private key với public key không phải X25519 (cần tạo lại keypair)")
+            shared_secret = my_private_key.exchange(their_public_key)
+        else:
+            # Keypair P-256 (mặc định của generate_keypair)
+            if not isinstance(their_public_key, ec.EllipticCurvePublicKey):
+                raise ValueError("Key type mismatch: P-256 private key với public key không phải EC (cần tạo lại keypair)")
+            shared_secret = my_private_key.exchange(
+                ec.ECDH(),
+                their_public_key
+            )
         
         # HKDF: Derive AES key from shared secret
-        aes_key = HKDF(
+        return HKDF(
             algorithm=hashes.SHA256(),
             length=32,  # 256 bits for AES-256
             salt=None,
             info=b'deltachat-e2ee',
             backend=self.backend
         ).derive(shared_secret)
-        
-        return aes_key
+    
+    def load_keypair_once(self, my_private_key_pem, their_public_key_pem):
+        """
+        Parse 1 lần cặp PEM → (private key object, public key object) để giữ lại dùng nhiều lần
+        với derive_shared_key_obj (server-side, ví dụ batch job); Flask session là cookie nên không giữ được object
+        """
+        return (
+            self._load_key(my_private_key_pem, private=True),
+            self._load_key(their_public_key_pem, private=False)
+        )
+    
+    def _load_key(self, pem, private):
+        """Parse PEM → key object (cache LRU theo digest của PEM)"""
+        cache_key = _pem_digest('private' if private else 'public', pem)
+        key = self._key_objects.get(cache_key)
+        if key is None:
+            if private:
+                key = serialization.load_pem_private_key(pem.encode('utf-8'), password=None, backend=self.backend)
+            else:
+                key = serialization.load_pem_public_key(pem.encode('utf-8'), backend=self.backend)
+            self._key_objects.put(cache_key, key)
+        return key
     
     # ===== ENCRYPTION / DECRYPTION =====
     
+    def _cipher_state(self, aes_key):
+        """
+        (AESGCM, nonce counter) cho aes_key, cache LRU
+        Counter bắt đầu từ 1 điểm ngẫu nhiên 96-bit (os.urandom 1 lần / key / process) rồi tăng dần:
+        không lặp trong process, và các process/lần restart dùng chung shared key (ECDH tĩnh)
+        chỉ đụng nhau nếu 2 dãy chồng lên nhau trong không gian 2^96
+        """
+        state = self._ciphers.get(aes_key)
+        if state is None:
+            start = int.from_bytes(os.urandom(NONCE_SIZE), 'big')
+            state = (AESGCM(aes_key), itertools.count(start))
+            self._ciphers.put(aes_key, state)
+        return state
+    
+    def _aesgcm(self, aes_key):
+        """AESGCM cho aes_key (cache LRU, AESGCM object dùng lại được cho nhiều nonce)"""
+        return self._cipher_state(aes_key)[0]
+    
     def encrypt_message(self, message, aes_key):
         """
         Mã hóa message với AES-GCM-256
         Return: base64(nonce + ciphertext + tag)
         """
-        # Create AESGCM cipher
-        aesgcm = AESGCM(aes_key)
+        # Create AESGCM cipher (cached)
+        aesgcm, counter = self._cipher_state(aes_key)
         
-        # Generate random nonce (96 bits recommended for GCM)
-        nonce = os.urandom(12)
+        # Nonce 96-bit từ counter (GCM chỉ cần nonce không lặp; next() của itertools.count atomic dưới GIL)
+        nonce = (next(counter) % NONCE_SPACE).to_bytes(NONCE_SIZE, 'big')
+        data = message.encode('utf-8')
         
+        # nonce | ciphertext | tag trong 1 bytearray đúng size (không tạo bytes trung gian khi nối)
+        encrypted_blob = bytearray(NONCE_SIZE + len(data) + TAG_SIZE)
+        encrypted_blob[:NONCE_SIZE] = nonce
         # Encrypt message
         # GCM automatically adds authentication tag
-        ciphertext = aesgcm.encrypt(
+        encrypted_blob[NONCE_SIZE:] = aesgcm.encrypt(
             nonce,
-            message.encode('utf-8'),
+            data,
             None  # No additional authenticated data
         )
         
-        # Combine nonce + ciphertext and encode to base64
-        encrypted_blob = nonce + ciphertext
-        return base64.b64encode(encrypted_blob).decode('utf-8')
+        return _b64encode_str(encrypted_blob)
     
     def decrypt_message(self, encrypted_base64, aes_key):
         """
@@ -119,14 +252,15 @@ class E2EEManager:
         """
         try:
             # Decode from base64
-            encrypted_blob = base64.b64decode(encrypted_base64)
+            encrypted_blob = _b64.b64decode(encrypted_base64, validate=False)
             
-            # Extract nonce and ciphertext
-            nonce = encrypted_blob[:12]
-            ciphertext = encrypted_blob[12:]
+            # Extract nonce and ciphertext (memoryview: không copy)
+            view = memoryview(encrypted_blob)
+            nonce = view[:NONCE_SIZE]
+            ciphertext = view[NONCE_SIZE:]
             
-            # Create AESGCM cipher
-            aesgcm = AESGCM(aes_key)
+            # Create AESGCM cipher (cached)
+            aesgcm = self._aesgcm(aes_key)
             
             # Decrypt and verify authentication tag
             plaintext = aesgcm.decrypt(nonce, ciphertext, None)
@@ -196,8 +330,8 @@ if __name__ == "__main__":
     print("4️⃣  Verifying ECDH shared secret...")
     alice_shared = e2ee.derive_shared_key(alice_private, bob_public)
     bob_shared = e2ee.derive_shared_key(bob_private, alice_public)
-    print(f"   Alice's shared key: {base64.b64encode(alice_shared[:8]).decode()}...")
-    print(f"   Bob's shared key:   {base64.b64encode(bob_shared[:8]).decode()}...")
+    print(f"   Alice's shared key: {_b64.b64encode(alice_shared[:8]).decode()}...")
+    print(f"   Bob's shared key:   {_b64.b64encode(bob_shared[:8]).decode()}...")
     print(f"   ✅ Shared keys match: {alice_shared == bob_shared}")
     print()
     
@@ -0,0 +1,40 @@
+"""
+JSON encode/decode nhanh bằng orjson (Rust C-extension) cho Flask jsonify và SocketIO
+Nếu chưa cài orjson thì app tự dùng json chuẩn của Flask/python-socketio
+"""
+
+try:
+    import orjson
+except ImportError:  # orjson là optional dependency
+    orjson = None
+
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider dùng orjson
+    - Giữ sort_keys như DefaultJSONProvider để output jsonify không đổi
+    - Kiểu orjson không hỗ trợ được fallback về DefaultJSONProvider.default
+    """
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class SocketIOJSON:
+    """Adapter module-like cho SocketIO(json=...) - python-socketio gọi dumps/loads với kwargs của json chuẩn"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
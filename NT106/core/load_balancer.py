@@ -3,26 +3,149 @@ Custom Load Balancer - Tự code không xài Nginx/HAProxy
 Implements: Round-Robin, Weighted Round-Robin, Health Checks
 """
 
+import asyncio
+import errno
+import hashlib
+import math
+import multiprocessing
+import os
+import select
+import signal
 import socket
+import selectors
 import threading
 import time
 import json
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from collections import deque
 import logging
 
+# uvloop optional: event loop libuv (C) cho LoadBalancer.start_async, không có thì dùng asyncio chuẩn
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Số worker tối đa xử lý kết nối đồng thời (thay cho 1 thread mới / kết nối)
+# Lưu ý: kết nối giữ lâu (WebSocket qua HTTP LB) chiếm 1 worker suốt vòng đời
+DEFAULT_MAX_WORKERS = 512
+FORWARD_BUFFER_SIZE = 64 * 1024
+
+# Linux (Python 3.10+): chuyển dữ liệu socket → pipe → socket hoàn toàn trong kernel
+HAS_SPLICE = hasattr(os, 'splice')
+
+# SO_REUSEPORT (Linux/BSD): nhiều process cùng listen 1 port, kernel chia SYN theo hash 4-tuple
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+# Health check: probe thẳng bằng socket, chỉ đọc status line
+HEALTH_CHECK_TIMEOUT = 1  # giây
+HEALTH_CHECK_WORKERS = 8
+
+# Async mode: thời gian tối đa chờ client gửi xong request đầu tiên / connect tới backend
+REQUEST_READ_TIMEOUT = 5  # giây
+BACKEND_CONNECT_TIMEOUT = 5  # giây
+
+
+def _wait_fd(fd, events, timeout):
+    """Chờ fd sẵn sàng (socket có timeout là O_NONBLOCK ở mức fd nên splice có thể trả EAGAIN)"""
+    poller = select.poll()
+    poller.register(fd, events)
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout("timed out")
+
+
+def _parse_content_length(buf, headers_end):
+    """
+    Content-Length từ header block (bytes, không decode/split từng dòng)
+    Header name không phân biệt hoa thường → lower() 1 lần cả block rồi find
+    :return: int, 0 nếu không có header / giá trị hỏng
+    """
+    headers = bytes(buf[:headers_end]).lower()
+    idx = headers.find(b'\r\ncontent-length:')
+    if idx < 0:
+        return 0
+    start = idx + 17  # len(b'\r\ncontent-length:')
+    end = headers.find(b'\r\n', start)
+    try:
+        return int(headers[start:end if end >= 0 else headers_end])
+    except ValueError:
+        return 0
+
+
+class SocketRelay:
+    """
+    Chép dữ liệu socket → socket theo từng chunk 64KB
+    - Linux: os.splice qua 1 pipe, bytes không đi qua Python
+    - Còn lại: recv_into 1 buffer dùng lại + sendall trên memoryview (không cấp bytes mới mỗi chunk)
+    """
+    
+    def __init__(self):
+        self.pipe = os.pipe() if HAS_SPLICE else None
+        self.buffer = bytearray(FORWARD_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+    
+    def chunk(self, source, destination):
+        """Chuyển 1 chunk; trả về số byte (0 = EOF)"""
+        if self.pipe:
+            try:
+                return self._splice_chunk(source, destination)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # Kernel/socket không hỗ trợ splice (chưa có byte nào bị lấy đi) → dùng buffer
+                self.close()
+        
+        n = source.recv_into(self.buffer)
+        if n:
+            destination.sendall(self.view[:n])
+        return n
+    
+    def _splice_chunk(self, source, destination):
+        pipe_r, pipe_w = self.pipe
+        while True:
+            try:
+                n = os.splice(source.fileno(), pipe_w, FORWARD_BUFFER_SIZE,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+                break
+            except BlockingIOError:
+                _wait_fd(source.fileno(), select.POLLIN, source.gettimeout())
+        
+        left = n
+        while left:
+            try:
+                left -= os.splice(pipe_r, destination.fileno(), left, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                _wait_fd(destination.fileno(), select.POLLOUT, destination.gettimeout())
+        return n
+    
+    def copy(self, source, destination):
+        """Chép tới khi source EOF"""
+        while self.chunk(source, destination):
+            pass
+    
+    def close(self):
+        if self.pipe:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
 
 class BackendServer:
     """Represents a backend server instance"""
     
+    # Không có __dict__ mỗi instance: nhỏ hơn, truy cập attribute qua slot offset cố định
+    __slots__ = ('host', 'port', 'weight', 'current_weight', 'healthy',
+                 'connections', 'total_requests', 'failed_checks', 'last_check')
+    
     def __init__(self, host, port, weight=1):
         self.host = host
         self.port = port
         self.weight = weight
+        self.current_weight = 0  # Smooth weighted round-robin state
         self.healthy = True
         self.connections = 0
         self.total_requests = 0
@@ -42,12 +165,18 @@ class LoadBalancer:
     - Connection pooling
     """
     
-    def __init__(self, listen_host='0.0.0.0', listen_port=8000):
+    def __init__(self, listen_host='0.0.0.0', listen_port=8000, max_workers=DEFAULT_MAX_WORKERS, workers=1):
         self.listen_host = listen_host
         self.listen_port = listen_port
+        # workers > 1: start() fork N process, mỗi process 1 listener SO_REUSEPORT (vượt GIL của 1 accept loop)
+        self.workers = workers if HAS_REUSEPORT else 1
+        self._worker_index = None  # Index trong process con, None ở process cha
+        self._worker_stats = None  # Shared array: process con ghi, cha cộng lại trong get_stats
         self.backends = []
-        self.current_backend_index = 0
         self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()  # Counter += từ nhiều worker không atomic
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lb-http')
+        self.health_pool = ThreadPoolExecutor(max_workers=HEALTH_CHECK_WORKERS, thread_name_prefix='lb-health')
         self.running = False
         self.stats = {
             'total_requests': 0,
@@ -65,7 +194,7 @@ class LoadBalancer:
         
     def get_next_backend(self, client_ip=None):
         """
-        Round-Robin with Weight support + STICKY SESSIONS
+        Smooth Weighted Round-Robin (kiểu Nginx) + STICKY SESSIONS
         
         Args:
             client_ip: Client IP for sticky session (optional)
@@ -77,12 +206,6 @@ class LoadBalancer:
             if not self.backends:
                 return None
             
-            # Filter healthy backends
-            healthy_backends = [b for b in self.backends if b.healthy]
-            if not healthy_backends:
-                logger.error("No healthy backends available!")
-                return None
-            
             # 🔥 STICKY SESSION: Check if client already has a session
             if client_ip and client_ip in self.session_table:
                 backend_idx = self.session_table[client_ip]
@@ -96,40 +219,113 @@ class LoadBalancer:
                         del self.session_table[client_ip]
                         logger.debug(f"🔄 Session expired: {client_ip} (backend unhealthy)")
             
-            # Weighted Round-Robin for new connections
-            # Create weighted list: [server1, server1, server1, server2, server2, ...]
-            weighted_list = []
-            for backend in healthy_backends:
-                weighted_list.extend([backend] * backend.weight)
+            # Nhiều worker process: session_table riêng từng process và kernel chia kết nối theo
+            # 4-tuple (gồm source port) → chọn backend theo hash IP để mọi process cho cùng 1 kết quả
+            if client_ip and self.workers > 1:
+                backend_idx = self._rendezvous_backend(client_ip)
+                if backend_idx < 0:
+                    logger.error("No healthy backends available!")
+                    return None
+                self.session_table[client_ip] = backend_idx
+                return self.backends[backend_idx]
             
-            # Round-robin through weighted list
-            backend = weighted_list[self.current_backend_index % len(weighted_list)]
-            self.current_backend_index += 1
+            # Smooth Weighted Round-Robin for new connections
+            # Mỗi lượt: current_weight += weight, chọn max, trừ total cho backend được chọn
+            # 1 vòng O(N), không dựng weighted list mỗi request
+            backend = None
+            backend_idx = -1
+            total = 0
+            for idx, candidate in enumerate(self.backends):
+                if not candidate.healthy:
+                    continue
+                candidate.current_weight += candidate.weight
+                total += candidate.weight
+                if backend is None or candidate.current_weight > backend.current_weight:
+                    backend = candidate
+                    backend_idx = idx
+            
+            if backend is None:
+                logger.error("No healthy backends available!")
+                return None
+            backend.current_weight -= total
             
             # 🔥 Save session mapping
-            if client_ip and backend:
-                backend_idx = self.backends.index(backend)
+            if client_ip:
                 self.session_table[client_ip] = backend_idx
                 logger.debug(f"📌 New session: {client_ip} → {backend.host}:{backend.port}")
             
             return backend
     
+    def _rendezvous_backend(self, client_ip):
+        """
+        Weighted rendezvous hashing: score = -weight / ln(h(ip, backend)), lấy max
+        Không cần state chung giữa các process; backend down chỉ dời các IP đang gắn với nó
+        """
+        best_idx = -1
+        best_score = 0.0
+        for idx, candidate in enumerate(self.backends):
+            if not candidate.healthy:
+                continue
+            digest = hashlib.blake2b(f"{client_ip}|{candidate.host}:{candidate.port}".encode('utf-8'), digest_size=8).digest()
+            h = (int.from_bytes(digest, 'big') + 1) / 18446744073709551617  # (0, 1)
+            score = -candidate.weight / math.log(h)
+            if best_idx < 0 or score > best_score:
+                best_idx, best_score = idx, score
+        return best_idx
+    
     def check_health(self, backend):
-        """Health check for a backend server"""
+        """
+        Health check for a backend server
+        GET /health qua raw socket (HTTP/1.0, chỉ đọc status line) thay cho requests:
+        không dựng Session, không parse cả response
+        """
+        status_line = b''
         try:
-            url = f"http://{backend.host}:{backend.port}/health"
-            response = requests.get(url, timeout=1)  # Giảm từ 2s xuống 1s
-            
-            if response.status_code == 200:
-                backend.healthy = True
-                backend.failed_checks = 0
-                backend.last_check = datetime.now()
-                return True
-            else:
-                backend.failed_checks += 1
+            with socket.create_connection((backend.host, backend.port), timeout=HEALTH_CHECK_TIMEOUT) as probe:
+                probe.sendall(self._health_request(backend))
+                while b'\r\n' not in status_line and len(status_line) < 64:
+                    chunk = probe.recv(64)
+                    if not chunk:
+                        break
+                    status_line += chunk
         except Exception as e:
-            backend.failed_checks += 1
             logger.warning(f"Health check failed for {backend}: {e}")
+            status_line = b''
+        return self._record_health(backend, status_line)
+    
+    async def check_health_async(self, backend):
+        """Như check_health nhưng non-blocking trên event loop (không chiếm thread của health_pool)"""
+        status_line = b''
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(backend.host, backend.port), HEALTH_CHECK_TIMEOUT)
+            writer.write(self._health_request(backend))
+            status_line = await asyncio.wait_for(reader.readline(), HEALTH_CHECK_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Health check failed for {backend}: {e!r}")
+            status_line = b''
+        finally:
+            if writer is not None:
+                writer.close()
+        return self._record_health(backend, status_line)
+    
+    @staticmethod
+    def _health_request(backend):
+        return b'GET /health HTTP/1.0\r\nHost: ' + backend.host.encode('ascii') + b'\r\n\r\n'
+    
+    @staticmethod
+    def _record_health(backend, status_line):
+        """Cập nhật trạng thái backend theo status line nhận được (b'' = lỗi kết nối/timeout)"""
+        # "HTTP/1.x 200 OK"
+        parts = status_line.split(b' ', 2)
+        if len(parts) >= 2 and parts[0].startswith(b'HTTP/1.') and parts[1] == b'200':
+            backend.healthy = True
+            backend.failed_checks = 0
+            backend.last_check = datetime.now()
+            return True
+        
+        backend.failed_checks += 1
         
         # Mark as unhealthy after 3 consecutive failures
         if backend.failed_checks >= 3:
@@ -142,15 +338,16 @@ class LoadBalancer:
     def health_check_loop(self):
         """Background thread for health checking"""
         while self.running:
-            for backend in self.backends:
-                self.check_health(backend)
+            # Check tất cả backend song song: 1 backend treo không làm chậm cả vòng
+            list(self.health_pool.map(self.check_health, self.backends))
+            self._publish_stats()
             time.sleep(5)  # Check every 5 seconds
     
     def handle_http_connection(self, client_socket, client_addr):
         """Handle HTTP request and proxy to backend"""
         try:
-            # Receive request from client
-            request_data = b''
+            # Receive request from client (bytearray.extend: không cấp lại cả buffer mỗi chunk)
+            request_data = bytearray()
             client_socket.settimeout(0.5)  # Short timeout - chỉ cần đủ để đọc request
             
             content_length = 0
@@ -159,22 +356,20 @@ class LoadBalancer:
             
             while True:
                 try:
-                    chunk = client_socket.recv(4096)
+                    chunk = client_socket.recv(FORWARD_BUFFER_SIZE)
                     if not chunk:
                         break
-                    request_data += chunk
+                    # Chỉ scan lại phần mới nhận (+3 byte đuôi cũ phòng \r\n\r\n nằm vắt qua 2 chunk)
+                    scan_from = max(len(request_data) - 3, 0)
+                    request_data.extend(chunk)
                     
                     # Check if we have complete HTTP headers
-                    if not headers_complete and b'\r\n\r\n' in request_data:
-                        headers_complete = True
-                        headers_end = request_data.find(b'\r\n\r\n')
-                        headers = request_data[:headers_end].decode('utf-8', errors='ignore')
-                        
-                        # Parse Content-Length
-                        for line in headers.split('\r\n'):
-                            if line.lower().startswith('content-length:'):
-                                content_length = int(line.split(':')[1].strip())
-                                break
+                    if not headers_complete:
+                        headers_end = request_data.find(b'\r\n\r\n', scan_from)
+                        if headers_end >= 0:
+                            headers_complete = True
+                            # Parse Content-Length
+                            content_length = _parse_content_length(request_data, headers_end)
                     
                     # Check if we have complete request (headers + body)
                     if headers_complete:
@@ -203,37 +398,41 @@ class LoadBalancer:
             if not backend:
                 client_socket.sendall(b'HTTP/1.1 503 Service Unavailable\r\n\r\n')
                 client_socket.close()
-                self.stats['total_failures'] += 1
+                with self.stats_lock:
+                    self.stats['total_failures'] += 1
                 return
             
             # Connect to backend
             backend_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             backend_socket.settimeout(5)  # Giảm từ 10s xuống 5s
+            connected = False
+            relay = SocketRelay()
             
             try:
                 backend_socket.connect((backend.host, backend.port))
-                backend.connections += 1
-                backend.total_requests += 1
-                self.stats['total_requests'] += 1
+                with self.stats_lock:
+                    backend.connections += 1
+                    backend.total_requests += 1
+                    self.stats['total_requests'] += 1
+                connected = True
                 
                 # Forward request to backend
-                backend_socket.sendall(request_data)
+                backend_socket.sendall(memoryview(request_data))
                 
                 # Receive response from backend and forward to client
-                while True:
-                    response_data = backend_socket.recv(4096)
-                    if not response_data:
-                        break
-                    client_socket.sendall(response_data)
-                
-                backend.connections -= 1
+                relay.copy(backend_socket, client_socket)
                 
             except Exception as e:
                 logger.error(f"Error proxying to {backend}: {e}")
                 client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
                 backend.healthy = False
-                self.stats['total_failures'] += 1
+                with self.stats_lock:
+                    self.stats['total_failures'] += 1
             finally:
+                if connected:
+                    with self.stats_lock:
+                        backend.connections -= 1
+                relay.close()
                 backend_socket.close()
                 
         except Exception as e:
@@ -246,17 +445,81 @@ class LoadBalancer:
         self.running = True
         self.stats['start_time'] = datetime.now()
         
+        if self.workers > 1:
+            self._start_workers()
+            return
+        
         # Start health check thread
         health_thread = threading.Thread(target=self.health_check_loop, daemon=True)
         health_thread.start()
         logger.info("Health check thread started")
         
-        # Start HTTP server
+        self._serve(self._listen_socket(reuse_port=False))
+    
+    def _listen_socket(self, reuse_port):
+        """Tạo listening socket (reuse_port: cho phép nhiều process bind cùng port)"""
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((self.listen_host, self.listen_port))
         server_socket.listen(100)
+        return server_socket
+    
+    def _start_workers(self):
+        """
+        Fork self.workers process, mỗi process: listener SO_REUSEPORT + worker pool + health check riêng
+        Process cha chỉ chạy health check (cho get_stats) và chờ các process con
+        """
+        ctx = multiprocessing.get_context('fork')
+        self._worker_stats = ctx.Array('q', self.workers * self._stats_row_size(), lock=False)
+        processes = [
+            ctx.Process(target=self._worker_main, args=(index,), name=f'lb-http-{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        logger.info(f"Started {self.workers} load balancer worker processes (SO_REUSEPORT)")
         
+        health_thread = threading.Thread(target=self.health_check_loop, daemon=True)
+        health_thread.start()
+        
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            logger.info("Shutting down load balancer...")
+        finally:
+            self.running = False
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+    
+    def _worker_main(self, index):
+        """Entry point của 1 worker process"""
+        # Ctrl+C: thoát thẳng, không chạy lại signal handler của process cha (run_cluster)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self._worker_index = index
+        health_thread = threading.Thread(target=self.health_check_loop, daemon=True)
+        health_thread.start()
+        self._serve(self._listen_socket(reuse_port=True))
+    
+    def _stats_row_size(self):
+        # [total_requests, total_failures] + [connections, total_requests] mỗi backend
+        return 2 + 2 * len(self.backends)
+    
+    def _publish_stats(self):
+        """Process con: chép counter vào shared array (mỗi vòng health check, không đụng hot path)"""
+        if self._worker_stats is None or self._worker_index is None:
+            return
+        row = [self.stats['total_requests'], self.stats['total_failures']]
+        for backend in self.backends:
+            row += (backend.connections, backend.total_requests)
+        start = self._worker_index * self._stats_row_size()
+        self._worker_stats[start:start + len(row)] = row
+    
+    def _serve(self, server_socket):
+        """Accept loop trên server_socket, kết nối đưa vào worker pool"""
         logger.info(f"Load Balancer listening on {self.listen_host}:{self.listen_port}")
         logger.info(f"Backend servers: {len(self.backends)}")
         for backend in self.backends:
@@ -266,55 +529,303 @@ class LoadBalancer:
             while self.running:
                 client_socket, client_addr = server_socket.accept()
                 
-                # Handle in new thread
-                client_thread = threading.Thread(
-                    target=self.handle_http_connection,
-                    args=(client_socket, client_addr),
-                    daemon=True
-                )
-                client_thread.start()
+                # Handle in worker pool (bounded, không tạo thread mới mỗi kết nối)
+                self.pool.submit(self.handle_http_connection, client_socket, client_addr)
                 
         except KeyboardInterrupt:
             logger.info("Shutting down load balancer...")
         finally:
             server_socket.close()
             self.running = False
+            self.pool.shutdown(wait=False)
+    
+    # ===== ASYNC MODE (asyncio / uvloop) =====
+    
+    def start_async(self):
+        """
+        Start the load balancer trên 1 event loop (uvloop nếu có) thay cho worker pool
+        1 thread giữ được rất nhiều kết nối đồng thời; forward 2 chiều nên WebSocket upgrade đi qua được
+        """
+        if uvloop:
+            uvloop.install()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Shutting down load balancer...")
+        finally:
+            self.running = False
+    
+    async def serve(self):
+        self.running = True
+        self.stats['start_time'] = datetime.now()
+        
+        health_task = asyncio.ensure_future(self._health_check_task())
+        server = await asyncio.start_server(self.handle_http, self.listen_host, self.listen_port,
+                                            backlog=100, reuse_address=True)
+        
+        logger.info(f"Load Balancer (async{', uvloop' if uvloop else ''}) listening on {self.listen_host}:{self.listen_port}")
+        logger.info(f"Backend servers: {len(self.backends)}")
+        for backend in self.backends:
+            logger.info(f"  - {backend}")
+        
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            health_task.cancel()
+    
+    async def _health_check_task(self):
+        """Health check loop dạng task: probe mọi backend đồng thời trên event loop, vòng check = backend chậm nhất"""
+        while self.running:
+            await asyncio.gather(*(self.check_health_async(backend) for backend in self.backends))
+            await asyncio.sleep(5)  # Check every 5 seconds
+    
+    async def handle_http(self, reader, writer):
+        """Đọc request đầu (headers + Content-Length body), chọn backend rồi forward 2 chiều"""
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else None
+        backend = None
+        backend_writer = None
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_READ_TIMEOUT)
+                content_length = _parse_content_length(head, len(head) - 4)
+                body = await asyncio.wait_for(reader.readexactly(content_length), REQUEST_READ_TIMEOUT) if content_length else b''
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+                return  # Client đóng / request hỏng
+            
+            backend = self.get_next_backend(client_ip=client_ip)
+            if not backend:
+                writer.write(b'HTTP/1.1 503 Service Unavailable\r\n\r\n')
+                with self.stats_lock:
+                    self.stats['total_failures'] += 1
+                return
+            
+            try:
+                backend_reader, backend_writer = await asyncio.wait_for(
+                    asyncio.open_connection(backend.host, backend.port), BACKEND_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.error(f"Error proxying to {backend}: {e}")
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+                backend.healthy = False
+                backend = None
+                with self.stats_lock:
+                    self.stats['total_failures'] += 1
+                return
+            
+            with self.stats_lock:
+                backend.connections += 1
+                backend.total_requests += 1
+                self.stats['total_requests'] += 1
+            
+            # Forward request to backend, sau đó pipe 2 chiều tới khi backend đóng
+            backend_writer.writelines((head, body))
+            upstream = asyncio.ensure_future(self._pipe(reader, backend_writer))
+            try:
+                await self._pipe(backend_reader, writer)
+            finally:
+                upstream.cancel()
+        
+        except Exception as e:
+            logger.error(f"Error handling connection from {peer}: {e}")
+        finally:
+            if backend_writer is not None:
+                backend_writer.close()
+                with self.stats_lock:
+                    backend.connections -= 1
+            writer.close()
+    
+    @staticmethod
+    async def _pipe(reader, writer):
+        """Chép reader → writer theo chunk 64KB; EOF thì half-close phía ghi"""
+        try:
+            while True:
+                data = await reader.read(FORWARD_BUFFER_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            pass
     
     def get_stats(self):
         """Get load balancer statistics"""
         uptime = (datetime.now() - self.stats['start_time']).total_seconds() if self.stats['start_time'] else 0
         
+        # Process cha của chế độ nhiều worker: cộng counter các process con (trễ tối đa 1 vòng health check)
+        counters = [self.stats['total_requests'], self.stats['total_failures']]
+        for b in self.backends:
+            counters += (b.connections, b.total_requests)
+        if self._worker_stats is not None and self._worker_index is None:
+            row_size = self._stats_row_size()
+            counters = [sum(self._worker_stats[i::row_size]) for i in range(row_size)]
+        
         return {
             'uptime_seconds': uptime,
-            'total_requests': self.stats['total_requests'],
-            'total_failures': self.stats['total_failures'],
+            'total_requests': counters[0],
+            'total_failures': counters[1],
             'backends': [
                 {
                     'address': f"{b.host}:{b.port}",
                     'healthy': b.healthy,
                     'weight': b.weight,
-                    'connections': b.connections,
-                    'total_requests': b.total_requests,
+                    'connections': counters[2 + 2 * i],
+                    'total_requests': counters[3 + 2 * i],
                     'last_check': b.last_check.isoformat() if b.last_check else None
                 }
-                for b in self.backends
+                for i, b in enumerate(self.backends)
             ]
         }
 
 
+class _RelayPeer:
+    """1 phía của cặp chuyển tiếp: socket + dữ liệu đọc từ phía kia còn chờ ghi vào socket này"""
+    
+    __slots__ = ('sock', 'peer', 'pending', 'events', 'closed')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.peer = None
+        self.pending = None  # memoryview phần chưa gửi được (peer ngừng đọc)
+        self.events = 0  # Event đang đăng ký với selector (0 = chưa đăng ký)
+        self.closed = False
+
+
+class TCPForwarder:
+    """
+    Chuyển tiếp 2 chiều cho mọi cặp (client, backend) trong 1 thread duy nhất bằng selectors
+    Thay cho 2 thread forward + join trên mỗi kết nối TCP
+    
+    Socket non-blocking: 1 phía ngừng đọc thì phần chưa gửi nằm trong pending của phía đó
+    (tối đa 1 chunk), thread chỉ chờ EVENT_WRITE và ngừng đọc chiều ngược lại (backpressure)
+    thay vì block cả loop → các cặp khác vẫn chạy
+    """
+    
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.thread = None
+        # Chỉ thread _loop dùng → 1 buffer nhận cho mọi cặp
+        self.buffer = bytearray(FORWARD_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+    
+    def add_pair(self, a, b):
+        """Đăng ký 1 cặp socket: data đọc từ bên này được ghi sang bên kia"""
+        peer_a, peer_b = _RelayPeer(a), _RelayPeer(b)
+        peer_a.peer, peer_b.peer = peer_b, peer_a
+        with self.lock:
+            for peer in (peer_a, peer_b):
+                peer.sock.setblocking(False)
+                peer.events = selectors.EVENT_READ
+                self.selector.register(peer.sock, selectors.EVENT_READ, peer)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+    
+    def _loop(self):
+        while True:
+            for key, mask in self.selector.select(timeout=1.0):
+                peer = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE and not peer.closed:
+                        self._flush(peer)
+                    if mask & selectors.EVENT_READ and not peer.closed:
+                        self._pump(peer)
+                except OSError:
+                    self._close_pair(peer)
+    
+    def _pump(self, source):
+        """Đọc 1 chunk từ source, ghi sang phía kia; phần chưa ghi được giữ lại trong pending"""
+        destination = source.peer
+        if destination.pending is not None:
+            return  # Đang backpressure (event cũ trong cùng lượt select)
+        
+        try:
+            n = source.sock.recv_into(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not n:
+            # EOF ở 1 phía → đóng cả cặp
+            self._close_pair(source)
+            return
+        
+        sent = self._send(destination.sock, self.view[:n])
+        if sent < n:
+            destination.pending = memoryview(bytes(self.view[sent:n]))
+            self._update(destination)
+            self._update(source)
+    
+    def _flush(self, destination):
+        """Socket ghi được trở lại: gửi tiếp pending, gửi hết thì đọc lại từ phía kia"""
+        pending = destination.pending
+        sent = self._send(destination.sock, pending)
+        if sent < len(pending):
+            destination.pending = pending[sent:]
+            return
+        
+        destination.pending = None
+        self._update(destination)
+        self._update(destination.peer)
+    
+    @staticmethod
+    def _send(sock, data):
+        try:
+            return sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+    
+    def _update(self, peer):
+        """Đăng ký lại event theo trạng thái: READ khi phía kia không còn pending, WRITE khi còn pending"""
+        events = 0
+        if peer.peer.pending is None:
+            events |= selectors.EVENT_READ
+        if peer.pending is not None:
+            events |= selectors.EVENT_WRITE
+        if events == peer.events:
+            return
+        
+        with self.lock:
+            if not peer.events:
+                self.selector.register(peer.sock, events, peer)
+            elif not events:
+                self.selector.unregister(peer.sock)
+            else:
+                self.selector.modify(peer.sock, events, peer)
+        peer.events = events
+    
+    def _close_pair(self, peer):
+        with self.lock:
+            for side in (peer, peer.peer):
+                if side.closed:
+                    continue
+                side.closed = True
+                side.pending = None
+                if side.events:
+                    try:
+                        self.selector.unregister(side.sock)
+                    except (KeyError, ValueError):
+                        pass
+                side.sock.close()
+
+
 class TCPLoadBalancer:
     """
     Load Balancer for TCP connections (for Messenger)
     Simple round-robin for TCP streams
     """
     
-    def __init__(self, listen_host='0.0.0.0', listen_port=9000):
+    def __init__(self, listen_host='0.0.0.0', listen_port=9000, max_workers=DEFAULT_MAX_WORKERS):
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.backends = []
         self.current_index = 0
         self.lock = threading.Lock()
         self.running = False
+        # Pool chỉ lo connect tới backend; forward dữ liệu do 1 thread selectors (non-blocking) đảm nhận
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lb-tcp')
+        self.forwarder = TCPForwarder()
         
     def add_backend(self, host, port):
         """Add TCP backend"""
@@ -341,32 +852,10 @@ class TCPLoadBalancer:
                 return
             
             # Connect to backend
-            backend_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            backend_socket.connect((backend['host'], backend['port']))
-            
-            # Bidirectional forwarding
-            def forward(source, destination):
-                try:
-                    while True:
-                        data = source.recv(4096)
-                        if not data:
-                            break
-                        destination.sendall(data)
-                except:
-                    pass
-                finally:
-                    source.close()
-                    destination.close()
-            
-            # Create two threads for bidirectional communication
-            t1 = threading.Thread(target=forward, args=(client_socket, backend_socket), daemon=True)
-            t2 = threading.Thread(target=forward, args=(backend_socket, client_socket), daemon=True)
-            
-            t1.start()
-            t2.start()
+            backend_socket = socket.create_connection((backend['host'], backend['port']), timeout=5)
             
-            t1.join()
-            t2.join()
+            # Bidirectional forwarding (selectors thread dùng chung)
+            self.forwarder.add_pair(client_socket, backend_socket)
             
         except Exception as e:
             logger.error(f"TCP proxy error: {e}")
@@ -387,19 +876,15 @@ class TCPLoadBalancer:
             while self.running:
                 client_socket, client_addr = server_socket.accept()
                 
-                # Handle in new thread
-                client_thread = threading.Thread(
-                    target=self.handle_tcp_connection,
-                    args=(client_socket, client_addr),
-                    daemon=True
-                )
-                client_thread.start()
+                # Connect tới backend trong worker pool, accept loop không bị chặn
+                self.pool.submit(self.handle_tcp_connection, client_socket, client_addr)
                 
         except KeyboardInterrupt:
             logger.info("Shutting down TCP load balancer...")
         finally:
             server_socket.close()
             self.running = False
+            self.pool.shutdown(wait=False)
 
 
 if __name__ == '__main__':
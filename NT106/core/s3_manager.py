@@ -1,9 +1,44 @@
+import atexit
 import boto3
 import os
-import uuid
+import secrets
+import time
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 import json
 from botocore.exceptions import ClientError
+
+try:
+    import orjson
+except ImportError:  # orjson là optional dependency, fallback json chuẩn
+    orjson = None
+
+# Content-Type theo extension (để trình duyệt hiển thị thay vì tải về)
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'pdf': 'application/pdf',
+}
+
+# Multipart upload: part 8MB, tối đa 10 part song song
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+TRANSFER_MAX_CONCURRENCY = 10
+# Pool HTTPS đủ cho multipart song song (mặc định botocore chỉ 10)
+S3_MAX_POOL_CONNECTIONS = 50
+
+# append_history: gom nhiều lần append thành 1 PUT khi idle HISTORY_FLUSH_DELAY giây,
+# nhưng không trễ quá HISTORY_FLUSH_MAX_DELAY nếu append liên tục
+HISTORY_FLUSH_DELAY = 5
+HISTORY_FLUSH_MAX_DELAY = 30
+
+# Presigned URL tối đa 7 ngày (giới hạn của SigV4)
+PRESIGNED_MAX_EXPIRES = 7 * 24 * 3600
+
 class S3Manager:
     def __init__(self):
         # Lấy cấu hình từ biến môi trường (đã load ở app.py hoặc config)
@@ -15,36 +50,84 @@ class S3Manager:
             's3',
             aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=self.region
+            region_name=self.region,
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': 3, 'mode': 'adaptive'}
+            )
+        )
+        
+        self.transfer_config = TransferConfig(
+            multipart_threshold=TRANSFER_CHUNK_SIZE,
+            multipart_chunksize=TRANSFER_CHUNK_SIZE,
+            max_concurrency=TRANSFER_MAX_CONCURRENCY,
+            use_threads=True
         )
-    def load_history(self, filename="chat_history.json"):
-        """Tải lịch sử chat từ S3 về"""
+        
+        # > 0: upload_file trả về presigned GET URL (bucket private, client tải thẳng từ S3)
+        # 0: trả về URL công khai như cũ
+        self.presigned_expires = min(int(os.getenv('AWS_S3_PRESIGNED_EXPIRES', 0)), PRESIGNED_MAX_EXPIRES)
+        
+        # History cache cho append_history: {filename: list}, flush debounce theo từng file
+        self._history = {}
+        self._history_lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # Serialize PUT: snapshot sau luôn ghi sau snapshot trước
+        self._flush_timers = {}  # {filename: Timer}
+        self._pending_since = {}  # {filename: monotonic của append đầu tiên chưa flush}
+        # Timer flush là daemon thread → tắt app trong lúc debounce sẽ mất entry nếu không flush lúc exit
+        atexit.register(self.flush_all_history)
+
+    def get_presigned_url(self, key, expires_in=3600):
+        """
+        Tạo presigned GET URL cho object (thời hạn nằm sẵn trong X-Amz-Expires của URL)
+        :return: String URL, None nếu lỗi
+        """
+        try:
+            return self.s3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.bucket_name, 'Key': key},
+                ExpiresIn=expires_in
+            )
+        except ClientError as e:
+            print(f"[ERROR] Không tạo được presigned URL: {e}")
+            return None
+
+    def load_history(self, filename="chat_history.json", strict=False):
+        """
+        Tải lịch sử chat từ S3 về
+        :param strict: True → lỗi khác NoSuchKey trả về None (để không ghi đè history thật bằng list rỗng)
+        """
         try:
             print(f"[*] Đang tải database từ S3: {filename}...")
             obj = self.s3.get_object(Bucket=self.bucket_name, Key=filename)
-            file_content = obj['Body'].read().decode('utf-8')
-            return json.loads(file_content)
+            # Parse thẳng từ bytes UTF-8, không decode ra str trung gian
+            file_content = obj['Body'].read()
+            return orjson.loads(file_content) if orjson else json.loads(file_content)
         except ClientError as e:
             if e.response['Error']['Code'] == "NoSuchKey":
                 print("[!] Chưa có lịch sử trên S3. Tạo mới.")
                 return [] # Trả về list rỗng nếu chưa có file
             else:
                 print(f"[ERROR] Không tải được history: {e}")
-                return []
+                return None if strict else []
         except Exception as e:
             print(f"[ERROR] Lỗi khác: {e}")
-            return []
+            return None if strict else []
 
     def save_history(self, data, filename="chat_history.json"):
         """Lưu (Ghi đè) lịch sử chat lên S3"""
         try:
             print(f"[*] Đang lưu database lên S3...")
-            json_str = json.dumps(data, ensure_ascii=False, indent=4)
+            # orjson trả về bytes UTF-8 luôn (không qua str rồi encode)
+            if orjson:
+                body = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+            else:
+                body = json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
             
             self.s3.put_object(
                 Bucket=self.bucket_name,
                 Key=filename,
-                Body=json_str.encode('utf-8'),
+                Body=body,
                 ContentType='application/json'
             )
             print("[SUCCESS] Đã đồng bộ Database lên Cloud S3.")
@@ -53,6 +136,58 @@ class S3Manager:
             print(f"[ERROR] Không lưu được history: {e}")
             return False
 
+    def append_history(self, entry, filename="chat_history.json"):
+        """
+        Thêm 1 entry vào lịch sử chat, ghi lên S3 theo lô (debounce) thay vì PUT cả file mỗi lần
+        :return: True nếu đã nhận entry, False nếu không tải được history hiện có
+        """
+        with self._history_lock:
+            history = self._history.get(filename)
+            if history is None:
+                history = self.load_history(filename, strict=True)
+                if history is None:
+                    return False
+                self._history[filename] = history
+            history.append(entry)
+            
+            now = time.monotonic()
+            since = self._pending_since.setdefault(filename, now)
+            timer = self._flush_timers.get(filename)
+            if timer is not None:
+                if now - since >= HISTORY_FLUSH_MAX_DELAY:
+                    return True  # Đã chờ đủ lâu: để timer hiện tại flush, không dời thêm
+                timer.cancel()
+            delay = min(HISTORY_FLUSH_DELAY, max(HISTORY_FLUSH_MAX_DELAY - (now - since), 0))
+            timer = threading.Timer(delay, self.flush_history, args=(filename,))
+            timer.daemon = True
+            self._flush_timers[filename] = timer
+            timer.start()
+        return True
+    
+    def flush_history(self, filename="chat_history.json"):
+        """Ghi ngay các entry đang chờ của append_history lên S3"""
+        with self._flush_lock:
+            with self._history_lock:
+                timer = self._flush_timers.pop(filename, None)
+                if timer is not None:
+                    timer.cancel()
+                if self._pending_since.pop(filename, None) is None:
+                    return True  # Không có gì chờ ghi
+                snapshot = list(self._history[filename])
+            
+            if not self.save_history(snapshot, filename):
+                # Ghi lỗi → đánh dấu lại còn pending để lần append/flush sau thử lại
+                with self._history_lock:
+                    self._pending_since.setdefault(filename, time.monotonic())
+                return False
+            return True
+    
+    def flush_all_history(self):
+        """Flush mọi file còn entry chờ ghi (đăng ký atexit trong __init__)"""
+        with self._history_lock:
+            pending = list(self._pending_since)
+        return all([self.flush_history(filename) for filename in pending])
+
     def upload_file(self, file_obj, original_filename):
         """
         Upload file lên S3 và trả về URL công khai.
@@ -62,15 +197,13 @@ class S3Manager:
         """
         try:
             # 1. Tạo tên file ngẫu nhiên để tránh trùng lặp trên S3
-            # Ví dụ: meo.jpg -> 123e4567-e89b...jpg
-            ext = original_filename.split('.')[-1]
-            unique_filename = f"{uuid.uuid4()}.{ext}"
+            # Ví dụ: meo.jpg -> Xq3v9_kLm2...jpg (128 bit ngẫu nhiên)
+            ext = os.path.splitext(original_filename)[1][1:].lower()
+            token = secrets.token_urlsafe(16)
+            unique_filename = f"{token}.{ext}" if ext else token
 
             # 2. Định nghĩa Content-Type (Quan trọng để trình duyệt hiển thị ảnh thay vì tải về)
-            content_type = 'application/octet-stream'
-            if ext.lower() in ['jpg', 'jpeg']: content_type = 'image/jpeg'
-            elif ext.lower() == 'png': content_type = 'image/png'
-            elif ext.lower() == 'gif': content_type = 'image/gif'
+            content_type = CONTENT_TYPES.get(ext, 'application/octet-stream')
 
             print(f"[*] Đang upload {original_filename} lên S3...")
 
@@ -80,12 +213,16 @@ class S3Manager:
                 file_obj,
                 self.bucket_name,
                 unique_filename,
-                ExtraArgs={'ContentType': content_type} 
+                ExtraArgs={'ContentType': content_type},
+                Config=self.transfer_config
             )
 
-            # 4. Tạo URL công khai
+            # 4. Tạo URL: presigned (nếu bật) hoặc công khai
             # Format chuẩn: https://{bucket}.s3.{region}.amazonaws.com/{key}
-            url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{unique_filename}"
+            if self.presigned_expires > 0:
+                url = self.get_presigned_url(unique_filename, self.presigned_expires)
+            else:
+                url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{unique_filename}"
             
             print(f"[SUCCESS] Upload thành công: {url}")
             return url
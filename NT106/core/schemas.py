@@ -0,0 +1,54 @@
+"""
+Request schemas cho các API route
+Decode + validate bằng msgspec (C extension) thay vì gọi request.json.get()/form.get() từng field
+"""
+
+from typing import Annotated
+
+import msgspec
+
+# String bắt buộc, không được rỗng
+NonEmptyStr = Annotated[str, msgspec.Meta(min_length=1)]
+
+# msgspec.ValidationError là subclass của DecodeError → bắt 1 lần cho cả JSON lỗi lẫn thiếu field
+SchemaError = msgspec.DecodeError
+
+
+class SendMessageRequest(msgspec.Struct):
+    """POST /api/send (multipart form)"""
+    recipient: NonEmptyStr
+    subject: str = '[Delta-Chat]'  # Subject đặc biệt để lọc
+    body: str = ''
+    encrypt: bool = False
+
+
+class EncryptRequest(msgspec.Struct):
+    """POST /api/encrypt"""
+    message: NonEmptyStr
+    my_private_key: NonEmptyStr
+    recipient_public_key: NonEmptyStr
+
+
+class DecryptRequest(msgspec.Struct):
+    """POST /api/decrypt"""
+    encrypted_message: NonEmptyStr
+    my_private_key: NonEmptyStr
+    sender_public_key: NonEmptyStr
+
+
+class UserIdRequest(msgspec.Struct):
+    """POST /api/user/find_by_id, /api/user/add_friend"""
+    user_id: str = ''
+
+
+def decode_json(data, schema):
+    """Decode JSON body (bytes) thẳng thành schema"""
+    return msgspec.json.decode(data, type=schema)
+
+
+def decode_form(form, schema):
+    """
+    Convert form fields (toàn string) thành schema
+    strict=False để 'true'/'false' → bool
+    """
+    return msgspec.convert(form.to_dict(), type=schema, strict=False)
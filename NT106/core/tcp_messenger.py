@@ -3,140 +3,383 @@ TCP MESSENGER - Direct P2P messaging using TCP sockets
 Thay thế SMTP/IMAP để đơn giản hóa
 """
 
+import abc
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import select
 import socket
+import struct
 import json
 import threading
 import time
+from collections import defaultdict, deque
 from datetime import datetime
 
-class TCPMessenger:
-    def __init__(self, host='0.0.0.0', port=9999):
-        """
-        Khởi tạo TCP server để nhận tin nhắn
-        
-        Args:
-            host: IP address to bind (0.0.0.0 = all interfaces)
-            port: Port number for TCP server
-        """
+try:
+    import orjson
+except ImportError:  # orjson là optional dependency, fallback json chuẩn
+    orjson = None
+
+# Log qua QueueHandler: thread gọi log chỉ put vào queue, QueueListener (thread riêng) mới ghi ra stderr
+# Mặc định WARNING: log từng message ở DEBUG, isEnabledFor chặn trước khi format
+# (MESSENGER_LOG_LEVEL=INFO/DEBUG để xem lifecycle / từng message)
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('MESSENGER_LOG_LEVEL', 'WARNING').upper())
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# uvloop optional: event loop libuv (C), ít overhead Python hơn mỗi lần accept/recv/send
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+SERVER_BACKLOG = 128
+SEND_TIMEOUT = 5.0  # giây (connect / chờ response)
+# send_message chờ coroutine trên loop: dài hơn connect + chờ response (mỗi bước tối đa SEND_TIMEOUT)
+SEND_CALL_TIMEOUT = 2 * SEND_TIMEOUT + 1.0
+
+# Framing TCP: 4 byte độ dài (big-endian) + JSON; 1 connection gửi được nhiều frame liên tiếp
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024
+
+# Keep-alive cho send_message: giữ connection rảnh theo địa chỉ thay vì connect/close mỗi tin nhắn
+CONNECTION_POOL_SIZE = 8     # connection rảnh tối đa / địa chỉ
+CONNECTION_MAX_IDLE = 30.0   # giây: rảnh lâu hơn thì đóng
+CLIENT_IDLE_TIMEOUT = 2 * CONNECTION_MAX_IDLE  # server đóng connection không gửi frame nào trong khoảng này
+
+UDP_RECV_BUFFER_SIZE = 65536  # Đủ cho datagram UDP lớn nhất
+
+# orjson: dumps ra thẳng bytes UTF-8, loads nhận bytes (không decode/encode trung gian)
+if orjson is not None:
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+    _loads_buffer = orjson.loads  # Nhận thẳng memoryview, không copy
+else:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    _loads = json.loads
+    
+    def _loads_buffer(view):
+        return json.loads(bytes(view))
+
+# Response cố định: encode 1 lần lúc import, không dumps mỗi message
+OK_RESPONSE = _dumps({"status": "success", "message": "Delivered"})
+NO_RECIPIENT_RESPONSE = _dumps({"status": "error", "message": "No recipient"})
+UDP_ACK = _dumps({"status": "success"})
+
+
+def _iso_timestamp(ts_ns):
+    """time.time_ns() → ISO string (giờ local, như datetime.now().isoformat())"""
+    return datetime.fromtimestamp(ts_ns / 1e9).isoformat()
+
+
+def _frame(payload):
+    """Payload bytes → frame (header độ dài + payload)"""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# Response cố định đóng frame sẵn: gửi thẳng 1 buffer, không pack header mỗi message
+_PREFRAMED = {payload: _frame(payload) for payload in (OK_RESPONSE, NO_RECIPIENT_RESPONSE)}
+
+
+def _write_frame(writer, payload):
+    """
+    Ghi 1 frame vào StreamWriter
+    Payload động: header + payload qua writelines (scatter-gather, transport gửi bằng sendmsg
+    trên Python 3.12+), không nối thành bytes mới
+    """
+    frame = _PREFRAMED.get(payload)
+    if frame is not None:
+        writer.write(frame)
+    else:
+        writer.writelines((FRAME_HEADER.pack(len(payload)), payload))
+
+
+async def _read_frame(reader):
+    """
+    Đọc 1 frame từ StreamReader
+    Return: payload bytes, None nếu peer đóng kết nối giữa 2 frame
+    Raise: ValueError nếu frame vượt MAX_FRAME_SIZE, IncompleteReadError nếu đứt giữa frame
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length} bytes")
+    return await reader.readexactly(length)
+
+class _BaseMessenger(abc.ABC):
+    """
+    Phần chung của TCP/UDP messenger: vòng đời server thread + message queue
+    Subclass chỉ cài transport: _server_loop (nhận) và send_message (gửi) - abstract,
+    thiếu thì lỗi ngay lúc khởi tạo thay vì trong daemon thread
+    """
+    PROTOCOL = None  # Tiền tố log: 'TCP' / 'UDP'
+    
+    def __init__(self, host, port):
         self.host = host
         self.port = port
         self.running = False
         self.server_thread = None
-        self.message_handlers = []
-        self.server_socket = None
         
-        # Message queue (in-memory)
-        self.message_queue = {}  # {user_email: [messages]}
-        
-        print(f"[TCP] Messenger initialized on {host}:{port}")
+        # Message queue (in-memory), ghi từ server thread, đọc từ request thread của Flask
+        self.message_queue = defaultdict(deque)  # {user_email: deque[messages]}
+        self._queue_lock = threading.Lock()
     
     def start_server(self):
-        """Khởi động TCP server để lắng nghe connections"""
+        """Khởi động server (thread riêng chạy _server_loop) để lắng nghe"""
         if self.running:
-            print("[TCP] Server already running")
+            logger.info("[%s] Server already running", self.PROTOCOL)
             return
         
         self.running = True
+        self._prepare_server()
         self.server_thread = threading.Thread(target=self._server_loop, daemon=True)
         self.server_thread.start()
-        print(f"[TCP] Server started on {self.host}:{self.port}")
+        logger.info("[%s] Server started on %s:%s", self.PROTOCOL, self.host, self.port)
+    
+    def _prepare_server(self):
+        """Hook chạy trên thread gọi start_server, trước khi server thread start"""
     
     def stop_server(self):
-        """Dừng TCP server"""
+        """Dừng server (server loop tự thoát khi thấy running = False)"""
         self.running = False
-        if self.server_socket:
+        logger.info("[%s] Server stopped", self.PROTOCOL)
+    
+    @abc.abstractmethod
+    def _server_loop(self):
+        """Chạy trong server thread: nhận message tới khi running = False"""
+    
+    @abc.abstractmethod
+    def send_message(self, sender, recipient, message, encrypted=False):
+        """Gửi tin nhắn, Returns: bool"""
+    
+    def _enqueue(self, message_data):
+        """
+        Hot path: gắn timestamp rồi đưa message vào queue của recipient
+        Timestamp là int time.time_ns() (không tạo datetime + format chuỗi mỗi message),
+        get_messages mới đổi sang ISO
+        Return: recipient, None nếu message không có recipient (bỏ qua)
+        """
+        recipient = message_data.get('recipient')
+        if not recipient:
+            return None
+        
+        message_data['timestamp'] = time.time_ns()
+        with self._queue_lock:
+            self.message_queue[recipient].append(message_data)
+        
+        logger.debug("[%s] Message from %s to %s", self.PROTOCOL, message_data.get('sender'), recipient)
+        return recipient
+    
+    @staticmethod
+    def _build_message(sender, recipient, message, encrypted):
+        """Message packet gửi đi"""
+        return {
+            'sender': sender,
+            'recipient': recipient,
+            'body': message,
+            'encrypted': encrypted,
+            'timestamp': time.time_ns()
+        }
+    
+    def get_messages(self, user_email, mark_read=True):
+        """
+        Lấy tin nhắn cho user từ queue
+        
+        Args:
+            user_email: Email của user
+            mark_read: Xóa tin nhắn sau khi lấy (default: True)
+        
+        Returns:
+            list: Danh sách tin nhắn (timestamp dạng ISO)
+        """
+        with self._queue_lock:
+            if mark_read:
+                # Xóa tin nhắn đã đọc: lấy hẳn deque ra khỏi dict, không copy
+                messages = self.message_queue.pop(user_email, ())
+            else:
+                messages = self.message_queue.get(user_email, ())
+            messages = list(messages)
+        
+        # Format timestamp ngoài lock, trên bản copy (mark_read=False: message vẫn nằm trong queue)
+        return [dict(message, timestamp=_iso_timestamp(message['timestamp'])) for message in messages]
+    
+    def has_messages(self, user_email):
+        """Check xem user có tin nhắn mới không"""
+        return bool(self.message_queue.get(user_email))
+
+
+class TCPMessenger(_BaseMessenger):
+    PROTOCOL = 'TCP'
+    
+    def __init__(self, host='0.0.0.0', port=9999, reuse_port=False):
+        """
+        Khởi tạo TCP server để nhận tin nhắn
+        
+        Args:
+            host: IP address to bind (0.0.0.0 = all interfaces)
+            port: Port number for TCP server
+            reuse_port: SO_REUSEPORT - nhiều instance cùng bind 1 port, kernel chia connection
+        """
+        super().__init__(host, port)
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.message_handlers = []
+        self.server_socket = None  # asyncio.Server khi đang chạy
+        self.loop = None
+        self._stop_event = None
+        # {(host, port): deque[(reader, writer, last_used)]}, chỉ truy cập từ event loop thread → không cần lock
+        self._conn_pool = {}
+        self._client_connections = {}  # {handler task: writer} của connection đang mở (keep-alive), đóng khi stop
+        
+        # Liveness flag cho /health (đọc O(1), không cần self-connect)
+        self.is_listening = False
+        self.last_heartbeat = 0.0
+        
+        logger.info("[TCP] Messenger initialized on %s:%s", host, port)
+    
+    def _prepare_server(self):
+        """Server chạy asyncio event loop trong thread riêng: tạo loop trước để send_message dùng được ngay"""
+        self.loop = self._new_event_loop()
+    
+    @staticmethod
+    def _new_event_loop():
+        """
+        uvloop nếu có, trừ khi app chạy eventlet/gevent: thread lúc đó là green thread,
+        epoll của libuv sẽ chặn cả hub (loop asyncio chuẩn dùng select đã monkey-patch nên nhường được)
+        """
+        green = getattr(select.select, '__module__', 'select') != 'select'
+        if uvloop is not None and not green:
+            return uvloop.new_event_loop()
+        return asyncio.new_event_loop()
+    
+    def stop_server(self):
+        """Dừng TCP server"""
+        if self.loop and self._stop_event:
             try:
-                self.server_socket.close()
-            except:
-                pass
-        print("[TCP] Server stopped")
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass  # Loop đã đóng
+        super().stop_server()
     
     def _server_loop(self):
-        """Main server loop - lắng nghe incoming connections"""
+        """Thread chạy event loop: 1 loop multiplex mọi connection (epoll), không tạo thread / connection"""
+        asyncio.set_event_loop(self.loop)
         try:
-            # Tạo TCP socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            self.server_socket.settimeout(1.0)  # Timeout để check self.running
-            
-            print(f"[TCP] Listening on {self.host}:{self.port}")
-            
-            while self.running:
-                try:
-                    # Accept connection
-                    client_socket, address = self.server_socket.accept()
-                    print(f"[TCP] Connection from {address}")
-                    
-                    # Handle trong thread riêng
-                    client_thread = threading.Thread(
-                        target=self._handle_client,
-                        args=(client_socket, address),
-                        daemon=True
-                    )
-                    client_thread.start()
-                    
-                except socket.timeout:
-                    continue  # Timeout để check self.running flag
-                except Exception as e:
-                    if self.running:
-                        print(f"[TCP ERROR] {e}")
-                    break
-        
+            self.loop.run_until_complete(self._serve())
         except Exception as e:
-            print(f"[TCP ERROR] Server loop: {e}")
+            logger.error("[TCP ERROR] Server loop: %s", e)
         finally:
-            if self.server_socket:
-                self.server_socket.close()
-            print("[TCP] Server loop ended")
+            self.is_listening = False
+            self.loop.close()
+            logger.info("[TCP] Server loop ended")
     
-    def _handle_client(self, client_socket, address):
-        """Xử lý request từ client"""
+    async def _serve(self):
+        """Main server coroutine - lắng nghe incoming connections tới khi stop_server()"""
+        self._stop_event = asyncio.Event()
+        if not self.running:
+            return  # stop_server() gọi trước khi loop kịp chạy
+        
+        self.server_socket = await asyncio.start_server(
+            self._handle_client_async, self.host, self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None, backlog=SERVER_BACKLOG
+        )
+        self.is_listening = True
+        logger.info("[TCP] Listening on %s:%s", self.host, self.port)
+        
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        reaper = asyncio.ensure_future(self._reap_idle_connections())
         try:
-            # Nhận data (max 4KB)
-            data = client_socket.recv(4096).decode('utf-8')
-            
-            if not data:
-                return
-            
-            # Parse JSON
-            message_data = json.loads(data)
-            
-            # Lưu vào message queue
-            recipient = message_data.get('recipient')
-            if recipient:
-                if recipient not in self.message_queue:
-                    self.message_queue[recipient] = []
-                
-                # Thêm timestamp
-                message_data['timestamp'] = datetime.now().isoformat()
-                message_data['delivered'] = True
+            await self._stop_event.wait()
+        finally:
+            heartbeat.cancel()
+            reaper.cancel()
+            self.is_listening = False
+            self._close_pool()
+            self.server_socket.close()
+            # Keep-alive connection không tự đóng: đóng transport → handler đọc EOF và tự kết thúc
+            for client_writer in self._client_connections.values():
+                client_writer.close()
+            await asyncio.gather(*self._client_connections, return_exceptions=True)
+            await self.server_socket.wait_closed()
+    
+    async def _heartbeat(self):
+        """Heartbeat cho healthy(): loop còn chạy thì cập nhật mỗi giây"""
+        while True:
+            self.last_heartbeat = time.time()
+            await asyncio.sleep(1.0)
+    
+    async def _handle_client_async(self, reader, writer):
+        """Xử lý request từ client: đọc từng frame tới khi client đóng kết nối, mỗi frame 1 response"""
+        address = writer.get_extra_info('peername')
+        logger.debug("[TCP] Connection from %s", address)
+        task = asyncio.current_task()
+        self._client_connections[task] = writer
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(_read_frame(reader), CLIENT_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break  # Keep-alive connection rảnh quá lâu
+                except ValueError as e:
+                    # Frame quá lớn: không đồng bộ lại được stream → trả lỗi rồi đóng
+                    logger.warning("[TCP ERROR] Handle client: %s", e)
+                    _write_frame(writer, _dumps({"status": "error", "message": str(e)}))
+                    await writer.drain()
+                    break
                 
-                self.message_queue[recipient].append(message_data)
+                if data is None:
+                    break
                 
-                print(f"[TCP] Message from {message_data.get('sender')} to {recipient}")
+                try:
+                    response = self._deliver(_loads(data))
+                except Exception as e:
+                    logger.warning("[TCP ERROR] Handle client: %s", e)
+                    response = _dumps({"status": "error", "message": str(e)})
                 
-                # Response OK
-                response = json.dumps({"status": "success", "message": "Delivered"})
-                client_socket.send(response.encode('utf-8'))
-            else:
-                response = json.dumps({"status": "error", "message": "No recipient"})
-                client_socket.send(response.encode('utf-8'))
-        
+                _write_frame(writer, response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # Client đứt giữa chừng
         except Exception as e:
-            print(f"[TCP ERROR] Handle client: {e}")
-            try:
-                response = json.dumps({"status": "error", "message": str(e)})
-                client_socket.send(response.encode('utf-8'))
-            except:
-                pass
+            logger.warning("[TCP ERROR] Handle client: %s", e)
         finally:
-            client_socket.close()
+            self._client_connections.pop(task, None)
+            writer.close()
+    
+    def _deliver(self, message_data):
+        """Lưu message vào queue, trả về response (bytes)"""
+        message_data['delivered'] = True
+        if self._enqueue(message_data) is None:
+            return NO_RECIPIENT_RESPONSE
+        return OK_RESPONSE
+    
+    def healthy(self, max_age=5.0):
+        """
+        Check server còn sống không mà không cần mở socket
+        
+        Returns:
+            bool: True nếu đang listen và accept loop có heartbeat trong max_age giây
+        """
+        return self.is_listening and (time.time() - self.last_heartbeat) < max_age
     
     def send_message(self, sender, recipient, message, encrypted=False):
         """
         Gửi tin nhắn đến recipient qua TCP
+        Wrapper đồng bộ cho send_message_async: chạy trên event loop của server nếu đang chạy
         
         Args:
             sender: Email người gửi
@@ -147,97 +390,136 @@ class TCPMessenger:
         Returns:
             bool: True nếu gửi thành công
         """
+        coro = self.send_message_async(sender, recipient, message, encrypted)
+        future = None
         try:
-            # Tạo message packet
-            message_data = {
-                'sender': sender,
-                'recipient': recipient,
-                'body': message,
-                'encrypted': encrypted,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            # Chuyển thành JSON
-            message_json = json.dumps(message_data)
+            if self.loop and self.loop.is_running():
+                future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+                return future.result(SEND_CALL_TIMEOUT)
+            return asyncio.run(coro)
+        except Exception as e:
+            if future is not None:
+                # Coroutine thuộc Task trên loop thread: cancel để Task tự dọn (writer.close) trên loop
+                future.cancel()
+            else:
+                coro.close()  # Chưa được schedule (loop đã đóng...) → tránh "never awaited"
+            logger.warning("[TCP ERROR] Send message: %s", e)
+            return False
+    
+    async def send_message_async(self, sender, recipient, message, encrypted=False):
+        """Như send_message nhưng là coroutine (asyncio.open_connection)"""
+        try:
+            # Tạo message packet → JSON (bytes)
+            message_json = _dumps(self._build_message(sender, recipient, message, encrypted))
             
             # Kết nối đến server (chính nó hoặc remote)
             # Trong local development, gửi đến chính server này
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5.0)
-            
-            # Connect to localhost (hoặc remote server nếu deploy)
-            client_socket.connect(('127.0.0.1', self.port))
-            
-            # Gửi data
-            client_socket.send(message_json.encode('utf-8'))
-            
-            # Nhận response
-            response = client_socket.recv(1024).decode('utf-8')
-            response_data = json.loads(response)
-            
-            client_socket.close()
+            response = await self._request(('127.0.0.1', self.port), message_json)
+            response_data = _loads(response)
             
             if response_data.get('status') == 'success':
-                print(f"[TCP] Message sent: {sender} -> {recipient}")
+                logger.debug("[TCP] Message sent: %s -> %s", sender, recipient)
                 return True
             else:
-                print(f"[TCP ERROR] Send failed: {response_data.get('message')}")
+                logger.warning("[TCP ERROR] Send failed: %s", response_data.get('message'))
                 return False
         
         except Exception as e:
-            print(f"[TCP ERROR] Send message: {e}")
+            logger.warning("[TCP ERROR] Send message: %s", e)
             return False
     
-    def get_messages(self, user_email, mark_read=True):
+    async def _request(self, addr, payload):
         """
-        Lấy tin nhắn cho user từ queue
-        
-        Args:
-            user_email: Email của user
-            mark_read: Xóa tin nhắn sau khi lấy (default: True)
-        
-        Returns:
-            list: Danh sách tin nhắn
+        Gửi 1 frame (payload), chờ frame response (connection lấy từ pool nếu đang chạy trên loop của server)
+        Connection trong pool đã bị server đóng (rảnh quá lâu, restart) → thử lại 1 lần bằng connection mới
         """
-        if user_email not in self.message_queue:
-            return []
-        
-        messages = self.message_queue[user_email].copy()
-        
-        if mark_read:
-            # Xóa tin nhắn đã đọc
-            self.message_queue[user_email] = []
+        pooled = asyncio.get_running_loop() is self.loop
+        while True:
+            reader, writer, reused = await self._acquire_connection(addr, pooled)
+            try:
+                # Gửi data
+                _write_frame(writer, payload)
+                await writer.drain()
+                
+                # Nhận response
+                response = await asyncio.wait_for(_read_frame(reader), SEND_TIMEOUT)
+                if response is None:
+                    raise ConnectionError("Connection closed before response")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            
+            if pooled:
+                self._release_connection(addr, reader, writer)
+            else:
+                writer.close()
+            return response
+    
+    async def _acquire_connection(self, addr, pooled):
+        """Return (reader, writer, reused): connection rảnh còn sống trong pool, không có thì mở mới"""
+        pool = self._conn_pool.get(addr) if pooled else None
+        now = time.monotonic()
+        while pool:
+            reader, writer, last_used = pool.pop()  # LIFO: connection vừa dùng xong
+            if writer.is_closing() or reader.at_eof() or now - last_used > CONNECTION_MAX_IDLE:
+                writer.close()
+                continue
+            return reader, writer, True
         
-        return messages
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), SEND_TIMEOUT)
+        return reader, writer, False
     
-    def has_messages(self, user_email):
-        """Check xem user có tin nhắn mới không"""
-        return user_email in self.message_queue and len(self.message_queue[user_email]) > 0
+    def _release_connection(self, addr, reader, writer):
+        """Trả connection về pool (đầy thì đóng)"""
+        pool = self._conn_pool.setdefault(addr, deque())
+        if len(pool) >= CONNECTION_POOL_SIZE:
+            writer.close()
+            return
+        pool.append((reader, writer, time.monotonic()))
+    
+    async def _reap_idle_connections(self):
+        """Đóng connection rảnh quá CONNECTION_MAX_IDLE (kiểm tra mỗi nửa chu kỳ)"""
+        while True:
+            await asyncio.sleep(CONNECTION_MAX_IDLE / 2)
+            deadline = time.monotonic() - CONNECTION_MAX_IDLE
+            for pool in self._conn_pool.values():
+                # Phần tử cũ nhất nằm đầu deque
+                while pool and pool[0][2] < deadline:
+                    pool.popleft()[1].close()
+    
+    def _close_pool(self):
+        for pool in self._conn_pool.values():
+            while pool:
+                pool.pop()[1].close()
+        self._conn_pool.clear()
 
 
-class UDPMessenger:
+class UDPMessenger(_BaseMessenger):
     """
     Alternative: UDP implementation (connectionless)
     Nhanh hơn TCP nhưng không đảm bảo delivery
     """
+    PROTOCOL = 'UDP'
+    
     def __init__(self, host='0.0.0.0', port=9998):
-        self.host = host
-        self.port = port
-        self.running = False
+        super().__init__(host, port)
         self.socket = None
-        self.message_queue = {}
         
-        print(f"[UDP] Messenger initialized on {host}:{port}")
-    
-    def start_server(self):
-        """Khởi động UDP server"""
-        if self.running:
-            return
+        # 1 socket gửi dùng suốt vòng đời (UDP không có state), lock giữ cặp sendto + chờ ACK
+        # để thread khác không đọc mất ACK
+        self._send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._send_sock.settimeout(2.0)
+        self._send_lock = threading.Lock()
         
-        self.running = True
-        self.thread = threading.Thread(target=self._server_loop, daemon=True)
-        self.thread.start()
-        print(f"[UDP] Server started on {self.host}:{self.port}")
+        # Buffer nhận dùng lại cho mọi datagram (recvfrom_into, không cấp bytes mới mỗi lần)
+        self._rx_buf = bytearray(UDP_RECV_BUFFER_SIZE)
+        
+        logger.info("[UDP] Messenger initialized on %s:%s", host, port)
     
     def _server_loop(self):
         """Main UDP server loop"""
@@ -245,92 +527,73 @@ class UDPMessenger:
             # Tạo UDP socket
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.socket.bind((self.host, self.port))
-            self.socket.settimeout(1.0)
+            self.socket.setblocking(False)
+            view = memoryview(self._rx_buf)
             
-            print(f"[UDP] Listening on {self.host}:{self.port}")
+            logger.info("[UDP] Listening on %s:%s", self.host, self.port)
             
             while self.running:
-                try:
-                    # Nhận datagram
-                    data, address = self.socket.recvfrom(4096)
-                    
-                    # Parse JSON
-                    message_data = json.loads(data.decode('utf-8'))
-                    
-                    # Lưu vào queue
-                    recipient = message_data.get('recipient')
-                    if recipient:
-                        if recipient not in self.message_queue:
-                            self.message_queue[recipient] = []
-                        
-                        message_data['timestamp'] = datetime.now().isoformat()
-                        self.message_queue[recipient].append(message_data)
-                        
-                        print(f"[UDP] Message from {message_data.get('sender')} to {recipient}")
-                        
-                        # Send ACK (optional)
-                        ack = json.dumps({"status": "success"})
-                        self.socket.sendto(ack.encode('utf-8'), address)
-                
-                except socket.timeout:
+                # Chờ readable tối đa 1s để check self.running (select: vẫn chạy khi eventlet/gevent patch)
+                readable, _, _ = select.select([self.socket], [], [], 1.0)
+                if not readable:
                     continue
-                except Exception as e:
-                    if self.running:
-                        print(f"[UDP ERROR] {e}")
+                
+                # Drain mọi datagram đang chờ trong 1 lần thức dậy
+                while True:
+                    try:
+                        # Nhận datagram
+                        nbytes, address = self.socket.recvfrom_into(view)
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        if self.running:
+                            logger.warning("[UDP ERROR] %s", e)
+                        break
+                    self._handle_datagram(view[:nbytes], address)
         
         except Exception as e:
-            print(f"[UDP ERROR] Server loop: {e}")
+            logger.error("[UDP ERROR] Server loop: %s", e)
         finally:
             if self.socket:
                 self.socket.close()
     
+    def _handle_datagram(self, data, address):
+        """Parse 1 datagram (memoryview vào _rx_buf, chỉ hợp lệ tới lần nhận kế tiếp) rồi đưa vào queue"""
+        try:
+            # Parse JSON
+            message_data = _loads_buffer(data)
+            
+            # Lưu vào queue
+            if self._enqueue(message_data) is not None:
+                # Send ACK (optional, socket non-blocking: buffer gửi đầy thì bỏ ACK)
+                self.socket.sendto(UDP_ACK, address)
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            if self.running:
+                logger.warning("[UDP ERROR] %s", e)
+    
     def send_message(self, sender, recipient, message, encrypted=False):
         """Gửi tin nhắn qua UDP"""
         try:
-            message_data = {
-                'sender': sender,
-                'recipient': recipient,
-                'body': message,
-                'encrypted': encrypted,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            message_json = json.dumps(message_data)
-            
-            # Tạo UDP socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(2.0)
-            
-            # Gửi datagram
-            sock.sendto(message_json.encode('utf-8'), ('127.0.0.1', self.port))
+            message_json = _dumps(self._build_message(sender, recipient, message, encrypted))
             
-            # Đợi ACK (optional)
-            try:
-                response, _ = sock.recvfrom(1024)
-                response_data = json.loads(response.decode('utf-8'))
-                print(f"[UDP] Message sent: {sender} -> {recipient}")
-                return True
-            except socket.timeout:
-                print(f"[UDP] No ACK received (but message might be delivered)")
-                return True  # UDP không đảm bảo, coi như OK
+            with self._send_lock:
+                # Gửi datagram
+                self._send_sock.sendto(message_json, ('127.0.0.1', self.port))
+                
+                # Đợi ACK (optional)
+                try:
+                    self._send_sock.recvfrom(1024)
+                    logger.debug("[UDP] Message sent: %s -> %s", sender, recipient)
+                    return True
+                except socket.timeout:
+                    logger.debug("[UDP] No ACK received (but message might be delivered)")
+                    return True  # UDP không đảm bảo, coi như OK
         
         except Exception as e:
-            print(f"[UDP ERROR] Send message: {e}")
+            logger.warning("[UDP ERROR] Send message: %s", e)
             return False
-        finally:
-            sock.close()
-    
-    def get_messages(self, user_email, mark_read=True):
-        """Lấy tin nhắn từ queue"""
-        if user_email not in self.message_queue:
-            return []
-        
-        messages = self.message_queue[user_email].copy()
-        
-        if mark_read:
-            self.message_queue[user_email] = []
-        
-        return messages
 
 
 # Test code
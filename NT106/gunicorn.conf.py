@@ -0,0 +1,26 @@
+"""
+Gunicorn config cho 1 backend instance (thay Werkzeug dev server)
+Chạy: gunicorn -c gunicorn.conf.py app:app
+
+- eventlet worker: mỗi WebSocket/HTTP connection là 1 green thread
+- 1 worker/instance: Flask-SocketIO cần sticky session, scale bằng nhiều instance sau load balancer
+- keepalive: giữ kết nối từ load balancer, tránh TCP handshake mỗi request
+"""
+
+import os
+
+# app.py đọc biến này trước khi import → phải set trước khi gunicorn load app
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'eventlet')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'eventlet'
+workers = 1
+worker_connections = 1000
+keepalive = 65
+timeout = 60
+
+
+def post_worker_init(worker):
+    """Worker đã load app: start TCP messenger + thread nền (import app không tự start)"""
+    from app import start_background_services
+    start_background_services()
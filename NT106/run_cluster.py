@@ -8,12 +8,30 @@ import os
 import sys
 import time
 import signal
+import socket
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from core.load_balancer import LoadBalancer, TCPLoadBalancer
 
 # Danh sách các process
 processes = []
 
+# Interpreter chạy backend (vd BACKEND_PYTHON=pypy3), mặc định dùng interpreter hiện tại
+BACKEND_PYTHON = os.environ.get('BACKEND_PYTHON', sys.executable)
+
+# LB_ASYNC=1: HTTP LB chạy trên asyncio/uvloop (1 event loop) thay cho thread pool
+LB_ASYNC = os.environ.get('LB_ASYNC') == '1'
+# LB_WORKERS=N: HTTP LB (thread pool) chạy N process SO_REUSEPORT, mặc định 1
+LB_WORKERS = int(os.environ.get('LB_WORKERS', '1'))
+# TCP_REUSEPORT=1: mọi backend TCPMessenger cùng bind TCP_PUBLIC_PORT (SO_REUSEPORT), kernel chia connection
+# → bỏ TCPLoadBalancer (mất weight + failover theo health check của TCP LB)
+TCP_REUSEPORT = os.environ.get('TCP_REUSEPORT') == '1'
+TCP_PUBLIC_PORT = 9000
+
+# Readiness probe: TCP connect tới flask_port thay cho sleep cố định
+BACKEND_READY_TIMEOUT = 30  # giây
+BACKEND_PROBE_INTERVAL = 0.05
+
 def start_backend_instance(port, tcp_port, instance_id):
     """Start a Flask backend instance"""
     env = os.environ.copy()
@@ -25,11 +43,13 @@ def start_backend_instance(port, tcp_port, instance_id):
     log_file = open(f'logs/instance_{instance_id}.log', 'w', buffering=1)
     
     process = subprocess.Popen(
-        [sys.executable, 'app.py'],
+        [BACKEND_PYTHON, 'app.py'],
         env=env,
         stdout=log_file,
         stderr=subprocess.STDOUT,  # Merge stderr to stdout
-        cwd=os.getcwd()
+        stdin=subprocess.DEVNULL,
+        cwd=os.getcwd(),
+        start_new_session=True  # Process group riêng: shutdown killpg được cả process con của backend
     )
     
     processes.append((process, log_file))
@@ -37,16 +57,39 @@ def start_backend_instance(port, tcp_port, instance_id):
     print(f"  Log: logs/instance_{instance_id}.log")
     return process
 
+def wait_until_ready(process, port, timeout=BACKEND_READY_TIMEOUT):
+    """
+    Chờ backend accept kết nối trên port
+    Returns: True nếu sẵn sàng, False nếu process đã thoát hoặc hết timeout
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False  # Backend crash lúc khởi động (xem log)
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.25):
+                return True
+        except OSError:
+            time.sleep(BACKEND_PROBE_INTERVAL)
+    return False
+
+def terminate_process(process):
+    """SIGTERM cho cả process group của backend, không có killpg (Windows) thì terminate()"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        process.terminate()
+
 def signal_handler(sig, frame):
     """Graceful shutdown"""
     print("\n\n🛑 Shutting down cluster...")
     for item in processes:
         if isinstance(item, tuple):
             process, log_file = item
-            process.terminate()
+            terminate_process(process)
             log_file.close()
         else:
-            item.terminate()
+            terminate_process(item)
     time.sleep(2)
     sys.exit(0)
 
@@ -73,28 +116,40 @@ def main():
         {'flask_port': 5003, 'tcp_port': 9993, 'weight': 1, 'id': 3},
     ]
     
+    if TCP_REUSEPORT:
+        for backend in backends:
+            backend['tcp_port'] = TCP_PUBLIC_PORT
+    
+    # Các backend độc lập nhau → start hết rồi probe song song
     for backend in backends:
-        start_backend_instance(backend['flask_port'], backend['tcp_port'], backend['id'])
-        time.sleep(2)  # Give more time to start
+        backend['process'] = start_backend_instance(backend['flask_port'], backend['tcp_port'], backend['id'])
     
     print()
     print("⏳ Waiting for backends to initialize...")
-    time.sleep(5)  # Wait longer for Flask to fully start
+    with ThreadPoolExecutor(max_workers=len(backends)) as pool:
+        ready = list(pool.map(lambda b: wait_until_ready(b['process'], b['flask_port']), backends))
+    for backend, ok in zip(backends, ready):
+        if ok:
+            print(f"   ✓ Instance {backend['id']} ready on :{backend['flask_port']}")
+        else:
+            print(f"   ⚠️  Instance {backend['id']} not ready (xem logs/instance_{backend['id']}.log)")
     
     # Start HTTP Load Balancer
     print()
     print("🔀 Starting HTTP Load Balancer...")
-    http_lb = LoadBalancer(listen_host='0.0.0.0', listen_port=8000)
+    http_lb = LoadBalancer(listen_host='0.0.0.0', listen_port=8000, workers=LB_WORKERS)
     
     for backend in backends:
         http_lb.add_backend('127.0.0.1', backend['flask_port'], weight=backend['weight'])
     
-    print()
-    print("🔀 Starting TCP Load Balancer...")
-    tcp_lb = TCPLoadBalancer(listen_host='0.0.0.0', listen_port=9000)
-    
-    for backend in backends:
-        tcp_lb.add_backend('127.0.0.1', backend['tcp_port'])
+    tcp_lb = None
+    if not TCP_REUSEPORT:
+        print()
+        print("🔀 Starting TCP Load Balancer...")
+        tcp_lb = TCPLoadBalancer(listen_host='0.0.0.0', listen_port=TCP_PUBLIC_PORT)
+        
+        for backend in backends:
+            tcp_lb.add_backend('127.0.0.1', backend['tcp_port'])
     
     print()
     print("="*70)
@@ -103,7 +158,10 @@ def main():
     print()
     print("📊 Access Points:")
     print(f"   HTTP Load Balancer:  http://0.0.0.0:8000")
-    print(f"   TCP Load Balancer:   tcp://0.0.0.0:9000")
+    if tcp_lb:
+        print(f"   TCP Load Balancer:   tcp://0.0.0.0:{TCP_PUBLIC_PORT}")
+    else:
+        print(f"   TCP (SO_REUSEPORT):  tcp://0.0.0.0:{TCP_PUBLIC_PORT}")
     print()
     print("🎯 Backend Instances:")
     for backend in backends:
@@ -121,11 +179,12 @@ def main():
     # Start load balancers in threads
     import threading
     
-    http_thread = threading.Thread(target=http_lb.start, daemon=False)
-    tcp_thread = threading.Thread(target=tcp_lb.start, daemon=False)
-    
+    http_thread = threading.Thread(target=http_lb.start_async if LB_ASYNC else http_lb.start, daemon=False)
     http_thread.start()
-    tcp_thread.start()
+    
+    if tcp_lb:
+        tcp_thread = threading.Thread(target=tcp_lb.start, daemon=False)
+        tcp_thread.start()
     
     # Stats monitor
     try:
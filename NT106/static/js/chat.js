@@ -37,15 +37,24 @@ document.addEventListener("DOMContentLoaded", function() {
         console.log('Connected to server via SocketIO');
     });
     
-    socket.on('new_message', function(data) {
+    function handleMessageEvent(data) {
         console.log('New message received:', data);
         
+        // Cuộc hội thoại mới → join room chung để nhận tin realtime
+        if (data.new_conversation) {
+            socket.emit('join_conversations');
+        }
+        
         // Fetch lại tin nhắn để đảm bảo sync với DB
         // Delay 200ms để tin kịp lưu vào DB
         setTimeout(function() {
             fetchMessages();
         }, 200);
-    });
+    }
+    
+    socket.on('new_message', handleMessageEvent);
+    // File đính kèm upload xong → body đã được cập nhật trong DB
+    socket.on('file_ready', handleMessageEvent);
 
     // Hiển thị tên file khi chọn ảnh
     fileInput.addEventListener("change", function() {